@@ -0,0 +1,97 @@
+"""
+Fake Domoticz module used to run the plugin outside of Domoticz (see bench/run.py).
+Logs are counted (and optionally printed), devices are kept in the Devices registry.
+"""
+
+Devices = {}
+Counts = {"Log": 0, "Status": 0, "Error": 0, "Debug": 0}
+Echo = False
+HeartbeatInterval = 10
+DebugLevel = 0
+
+
+def _log(kind, message):
+    Counts[kind] += 1
+    if Echo:
+        print("{:6} {}".format(kind, message))
+
+
+def Log(message):
+    _log("Log", message)
+
+
+def Status(message):
+    _log("Status", message)
+
+
+def Error(message):
+    _log("Error", message)
+
+
+def Debug(message):
+    if DebugLevel:
+        _log("Debug", message)
+
+
+def Debugging(level):
+    global DebugLevel
+    DebugLevel = level
+
+
+def Heartbeat(interval):
+    global HeartbeatInterval
+    HeartbeatInterval = interval
+
+
+class Device:
+
+    def __init__(self, Name="", Unit=0, TypeName="", Type=0, Subtype=0, Switchtype=0, Image=0, Options=None,
+                 Used=0, DeviceID=""):
+        self.Name = Name
+        self.Unit = Unit
+        self.TypeName = TypeName
+        self.ID = Unit
+        self.nValue = 0
+        self.sValue = ""
+        self.TimedOut = 0
+        self.LastLevel = 0
+        self.Options = Options or {}
+        self.Used = Used
+        self.Updates = 0
+
+    def Create(self):
+        Devices[self.Unit] = self
+
+    def Update(self, nValue=0, sValue="", TimedOut=0, **kwargs):
+        self.nValue = nValue
+        self.sValue = sValue
+        self.TimedOut = TimedOut
+        self.Updates += 1
+
+    def __str__(self):
+        return "Unit: {}, Name: '{}', nValue: {}, sValue: '{}'".format(self.Unit, self.Name, self.nValue, self.sValue)
+
+
+class Connection:
+
+    # no broker in the bench: connections never succeed
+    def __init__(self, Name="", Transport="", Protocol="", Address="", Port=""):
+        self.Name = Name
+        self.Address = Address
+        self.Port = Port
+        self.Sent = []
+
+    def Connect(self):
+        pass
+
+    def Connected(self):
+        return False
+
+    def Connecting(self):
+        return False
+
+    def Send(self, Message, Delay=0):
+        self.Sent.append(Message)
+
+    def Disconnect(self):
+        pass
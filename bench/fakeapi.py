@@ -0,0 +1,158 @@
+"""
+Local fake of the Domoticz JSON API serving a configurable device fleet (see bench/run.py).
+Only the calls used by the plugin are implemented: getdevices (filter= or rid=) and setsetpoint.
+"""
+import json
+import random
+import threading
+from collections import Counter
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+
+class Fleet:
+
+    # devices of a simulated installation. Each zone gets one inside sensor, one presence sensor and
+    # a TRV temperature sensor + setpoint device per heater, the rest of the fleet is filler devices.
+
+    def __init__(self, clock, devices=500, zones=1, heaters=2, seed=0):
+        self.clock = clock
+        self.rng = random.Random(seed)
+        self.devices = {}
+        self.zones = []
+        self.rooms = []  # simulated room temperature and radiator heat (0-1) per zone, see heat()
+        self.lock = threading.Lock()
+        idx = 1
+        for zone in range(zones):
+            layout = {"inside": [], "trv": [], "heaters": [], "presence": []}
+            layout["inside"].append(self._add(idx, "temp", "Room {} temp".format(zone), Temp=19.0))
+            layout["presence"].append(self._add(idx + 1, "light", "Room {} motion".format(zone), Status="Off"))
+            idx += 2
+            for heater in range(heaters):
+                layout["trv"].append(self._add(idx, "temp", "Room {} TRV {} temp".format(zone, heater), Temp=21.0))
+                layout["heaters"].append(self._add(idx + 1, "utility", "Room {} TRV {} setpoint".format(zone, heater),
+                                                   SetPoint="20.0"))
+                idx += 2
+            self.zones.append(layout)
+            self.rooms.append([19.0, 0.0])
+        kinds = ("temp", "light", "utility")
+        while len(self.devices) < devices:
+            kind = kinds[idx % 3]
+            fields = {"temp": {"Temp": 15.0}, "light": {"Status": "Off"}, "utility": {"Data": "0 kWh"}}[kind]
+            self._add(idx, kind, "Filler {}".format(idx), **fields)
+            idx += 1
+
+    def _add(self, idx, devfilter, name, **fields):
+        device = {"idx": str(idx), "Name": name, "HardwareName": "Zigbee", "HaveTimeout": False,
+                  "LastUpdate": self.clock().strftime("%Y-%m-%d %H:%M:%S"), "filter": devfilter}
+        device.update(fields)
+        self.devices[idx] = device
+        return idx
+
+    def step(self, changes=0.1, motion=0.05):
+        # move a part of the zone sensors: temperatures drift, motion sensors switch
+        now = self.clock().strftime("%Y-%m-%d %H:%M:%S")
+        with self.lock:
+            for layout in self.zones:
+                for idx in layout["inside"] + layout["trv"]:
+                    if self.rng.random() < changes:
+                        device = self.devices[idx]
+                        device["Temp"] = round(device["Temp"] + self.rng.uniform(-0.3, 0.3), 1)
+                        device["LastUpdate"] = now
+                for idx in layout["presence"]:
+                    if self.rng.random() < motion:
+                        device = self.devices[idx]
+                        device["Status"] = "Off" if device["Status"] == "On" else "On"
+                        device["LastUpdate"] = now
+
+    def heat(self, seconds, requests, gain=4.0, loss=0.08, outside=5.0, inertia=30.0):
+        # thermal simulation of the rooms instead of the random drift of step(): the radiators warm up
+        # (over inertia minutes) while the heating of the zone is requested and one of its TRV is open,
+        # the rooms lose loss * (temp - outside) degrees per hour
+        now = self.clock().strftime("%Y-%m-%d %H:%M:%S")
+        with self.lock:
+            for layout, room, request in zip(self.zones, self.rooms, requests):
+                opened = any(float(self.devices[heater]["SetPoint"]) > self.devices[trv]["Temp"]
+                             for heater, trv in zip(layout["heaters"], layout["trv"]))
+                target = 1.0 if request and opened else 0.0
+                room[1] += (target - room[1]) * min(1.0, seconds / (inertia * 60))
+                room[0] += seconds / 3600 * (gain * room[1] - loss * (room[0] - outside))
+                for idx in layout["inside"]:
+                    self.devices[idx].update(Temp=round(room[0], 1), LastUpdate=now)
+                for idx in layout["trv"]:
+                    self.devices[idx].update(Temp=round(room[0] + 2 * room[1], 1), LastUpdate=now)
+
+    def select(self, devfilter=None, rid=None):
+        with self.lock:
+            if rid is not None:
+                device = self.devices.get(int(rid))
+                return [dict(device)] if device else []
+            return [dict(device) for device in self.devices.values() if devfilter in ("all", device["filter"])]
+
+    def setsetpoint(self, idx, setpoint):
+        with self.lock:
+            device = self.devices.get(int(idx))
+            if device is None:
+                return False
+            device["SetPoint"] = setpoint
+            device["LastUpdate"] = self.clock().strftime("%Y-%m-%d %H:%M:%S")
+            return True
+
+
+class FakeAPI(ThreadingHTTPServer):
+
+    daemon_threads = True
+
+    def __init__(self, fleet, port=0):
+        super().__init__(("127.0.0.1", port), _Handler)
+        self.fleet = fleet
+        self.calls = Counter()
+        self.lock = threading.Lock()
+        self.down = False  # answer every call with HTTP 503
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self.server_address[1]
+
+    def count(self, param):
+        with self.lock:
+            self.calls[param] += 1
+
+    def takecalls(self):
+        with self.lock:
+            calls, self.calls = self.calls, Counter()
+        return calls
+
+
+class _Handler(BaseHTTPRequestHandler):
+
+    protocol_version = "HTTP/1.1"  # keep-alive
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        query = {key: values[0] for key, values in parse_qs(urlparse(self.path).query).items()}
+        param = query.get("param", "")
+        self.server.count(param)
+        if self.server.down:
+            self.send_response(503)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        fleet = self.server.fleet
+        answer = {"status": "OK", "title": param}
+        if param == "getdevices":
+            answer["result"] = fleet.select(query.get("filter", "all"), query.get("rid"))
+        elif param == "setsetpoint":
+            if not fleet.setsetpoint(query.get("idx", 0), query.get("setpoint")):
+                answer["status"] = "ERR"
+        else:
+            answer["status"] = "ERR"
+        body = json.dumps(answer).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
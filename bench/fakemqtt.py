@@ -0,0 +1,147 @@
+"""
+Local fake of an MQTT broker with zigbee2mqtt behind it, serving the TRV of a device fleet (see bench/run.py).
+Only what the plugin uses is implemented: MQTT 3.1.1 with QoS 0, <base>/<name>/set with the setpoint field,
+and the <base>/<name> states published when a setpoint is set or a TRV temperature changes (publish()).
+"""
+import json
+import socketserver
+import struct
+import threading
+from collections import Counter
+
+
+class FakeZigbee2Mqtt(socketserver.ThreadingTCPServer):
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, fleet, base="zigbee2mqtt", port=0):
+        super().__init__(("127.0.0.1", port), _Handler)
+        self.fleet = fleet
+        self.base = base
+        self.devices = {}  # friendly name: (TRV temperature idx, setpoint idx)
+        for zone, layout in enumerate(fleet.zones):
+            for heater, (trv, setpoint) in enumerate(zip(layout["trv"], layout["heaters"])):
+                self.devices["Room {} TRV {}".format(zone, heater)] = (trv, setpoint)
+        self.clients = []  # (handler, subscribed topics)
+        self.lock = threading.Lock()
+        self.messages = Counter()
+        self.temps = {}  # name: last TRV temperature published
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self.server_address[1]
+
+    def names(self):
+        # the "devices" member of the zigbee2mqtt settings
+        return {str(idx): name for name, idxs in self.devices.items() for idx in idxs}
+
+    def connected(self):
+        with self.lock:
+            return sum(1 for handler, topics in self.clients if topics)
+
+    def publish(self):
+        # report the TRV whose temperature changed since the last call
+        for name, (trv, setpoint) in self.devices.items():
+            temp = self.fleet.devices[trv]["Temp"]
+            if self.temps.get(name) != temp:
+                self.state(name)
+
+    def state(self, name):
+        trv, setpoint = self.devices[name]
+        temp = self.fleet.devices[trv]["Temp"]
+        self.temps[name] = temp
+        payload = {"local_temperature": temp, "current_heating_setpoint": float(self.fleet.devices[setpoint]["SetPoint"])}
+        self.send("{}/{}".format(self.base, name), json.dumps(payload).encode("utf-8"))
+
+    def send(self, topic, payload):
+        data = topic.encode("utf-8")
+        with self.lock:
+            handlers = [handler for handler, topics in self.clients if topic in topics]
+            self.messages["state"] += len(handlers)
+        for handler in handlers:
+            handler.packet(0x30, struct.pack("!H", len(data)) + data + payload)
+
+    def onset(self, topic, payload):
+        name = topic[len(self.base) + 1:-len("/set")]
+        if name not in self.devices:
+            return
+        self.messages["set"] += 1
+        try:
+            value = json.loads(payload.decode("utf-8"))["current_heating_setpoint"]
+        except (ValueError, KeyError):
+            return
+        self.fleet.setsetpoint(self.devices[name][1], str(value))
+        self.state(name)
+
+
+class _Handler(socketserver.BaseRequestHandler):
+
+    def setup(self):
+        self.topics = set()
+        self.lock = threading.Lock()
+        with self.server.lock:
+            self.server.clients.append((self, self.topics))
+
+    def finish(self):
+        with self.server.lock:
+            self.server.clients = [(handler, topics) for handler, topics in self.server.clients if handler is not self]
+
+    def handle(self):
+        try:
+            while True:
+                kind, body = self.read()
+                if kind == 0x10:
+                    self.packet(0x20, b"\x00\x00")  # CONNACK accepted
+                elif kind == 0x82:
+                    packetid, position, granted = body[:2], 2, b""
+                    while position < len(body):
+                        length = struct.unpack("!H", body[position:position + 2])[0]
+                        self.topics.add(body[position + 2:position + 2 + length].decode("utf-8"))
+                        position += 3 + length
+                        granted += b"\x00"
+                    self.packet(0x90, packetid + granted)
+                elif kind == 0xc0:
+                    self.packet(0xd0, b"")
+                elif kind & 0xf0 == 0x30:
+                    length = struct.unpack("!H", body[:2])[0]
+                    topic = body[2:2 + length].decode("utf-8")
+                    if topic.endswith("/set"):
+                        self.server.onset(topic, body[2 + length:])
+                elif kind == 0xe0:
+                    return
+        except OSError:
+            return
+
+    def read(self):
+        kind = self.recv(1)[0]
+        length, shift = 0, 0
+        while True:
+            byte = self.recv(1)[0]
+            length |= (byte & 0x7f) << shift
+            if not byte & 0x80:
+                break
+            shift += 7
+        return kind, self.recv(length)
+
+    def recv(self, size):
+        data = b""
+        while len(data) < size:
+            chunk = self.request.recv(size - len(data))
+            if not chunk:
+                raise OSError("closed")
+            data += chunk
+        return data
+
+    def packet(self, kind, body):
+        header, length = bytearray((kind,)), len(body)
+        while True:
+            byte, length = length & 0x7f, length >> 7
+            header.append(byte | 0x80 if length else byte)
+            if not length:
+                break
+        with self.lock:
+            try:
+                self.request.sendall(bytes(header) + body)
+            except OSError:
+                pass
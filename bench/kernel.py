@@ -0,0 +1,161 @@
+"""
+Benchmark of the SVT3 decision kernel alone, on random zone states.
+
+Runs the pure Python kernel of plugin.py and a vectorized NumPy version of it (kept here, the plugin stays
+pure Python: NumPy does not support the sub-interpreters of the Domoticz plugins) on the same zones, checks
+that they decide the same actions and reports the time of one pass:
+
+    python3 bench/kernel.py --zones 500 --passes 20
+"""
+import argparse
+import os
+import random
+import statistics
+import sys
+import time
+
+BENCHDIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BENCHDIR)
+sys.path.insert(1, os.path.dirname(BENCHDIR))
+
+import Domoticz  # the fake one from this folder
+import plugin
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+def randomzone(rng, now):
+    # one zone state in the order of plugin.DECISIONFIELDS, times around now
+    def around(minutes):
+        return now + rng.uniform(-minutes, minutes) * 60
+    normal = rng.choice((19.0, 20.0, 20.5, 21.0))
+    return (rng.choice((0, 10, 10, 10, 20)), rng.choice((10, 10, 20, 30)), rng.choice((0, 0, 1, 2)),
+            normal, normal - 2, rng.random() < 0.5, 10, 20,
+            round(rng.uniform(17, 23), 1), round(rng.uniform(17, 26), 1), rng.random() < 0.5, rng.random() < 0.05,
+            rng.random() < 0.2, around(60), 60,
+            rng.random() < 0.2, rng.random() < 0.2, around(5), 2, 1,
+            rng.random() < 0.8, normal, rng.choice((7, 19, 20, 21, 22, 28)), rng.random() < 0.3,
+            rng.choice((float("nan"), 7, 20, 21, 22, 28)), around(10), around(10),
+            rng.choice((float("nan"), normal, normal, normal - 2)))
+
+
+def decidevectorized(columns, now, hysteresis):
+
+    # same decisions as plugin.DecideZone, for all the zones at once on NumPy arrays
+    c = {field: numpy.asarray(columns[field], dtype=float) for field in plugin.DECISIONFIELDS}
+    control, mode, level = c["control"], c["mode"], c["level"]
+    presence, heat, intemperror, forced, pause, pauserequested, switchheat, held = (
+        c[field] != 0 for field in ("presence", "heat", "intemperror", "forced", "pause", "pauserequested",
+                                    "switchHeat", "TRVheld"))
+
+    # branches of the state machine
+    off = control == 0
+    forcedmode = control == 20
+    auto = ~off & ~forcedmode
+    forcedon = forcedmode & ~forced
+    forcedend = forcedmode & forced & (c["endheat"] <= now)
+    forcedoff = auto & forced
+    pausedue = auto & ~forced & (pause != pauserequested) & \
+        (c["pausechanged"] + 60 * numpy.where(pause, c["pauseoffdelay"], c["pauseondelay"]) <= now)
+    pauseoff = pausedue & pause
+    pauseon = pausedue & ~pause
+    steady = auto & ~forced & (pause == pauserequested)
+    night = steady & (mode == 10) & (level == 1)
+    scheduledeco = steady & (mode == 10) & (level == 2)
+    normal = steady & (mode == 10) & ~night & ~scheduledeco & presence
+    reduced = steady & (mode == 10) & ~night & ~scheduledeco & ~presence
+    eco = steady & (mode == 20)
+    vacation = steady & (mode != 10) & (mode != 20)
+
+    setpoint = numpy.select([night, scheduledeco, normal, reduced, eco, vacation],
+                            [c["normal"] - c["reducnuit"] / 10, c["eco"], c["normal"], c["normal"] - c["reducjour"] / 10,
+                             c["eco"], 15.0], c["setpoint"])
+
+    # TRV setpoint corrected by the TRV temperature, within the hysteresis band and hold time
+    raw = setpoint - (c["predicted"] - c["trvtemp"])
+    target = numpy.ceil(raw)
+    last = c["TRVsent"]
+    band = hysteresis["trv"]
+    with numpy.errstate(invalid="ignore"):
+        free = numpy.isnan(last) | (target == last) | (last == 7) | (last == 28) | (setpoint != c["TRVsentfor"])
+        hold = ~free & (((last - 1 - band < raw) & (raw <= last + band)) |
+                        (c["TRVchanged"] + 60 * hysteresis["trv_hold"] > now))
+    corrected = forcedend | forcedoff | pauseoff | steady
+    trvsetpoint = numpy.select([off | pauseon, forcedon, corrected], [7.0, 28.0, numpy.where(hold, last, target)],
+                               c["TRVsetpoint"])
+    trvheld = numpy.where(corrected, hold, held)
+
+    newforced = (forced & ~(off | forcedend | forcedoff)) | forcedon
+    endheat = numpy.select([forcedon, forcedend], [now + 60 * c["forcedduration"], now], c["endheat"])
+    newcontrol = numpy.where(forcedend, 10.0, control)
+    switch = (switchheat & ~(off | forcedend | pauseon)) | forcedon | forcedoff | pauseoff | steady
+    newpause = (pause & ~pauseoff) | pauseon
+    heat = (heat & ~(off | forcedend | forcedoff | pauseon)) | forcedon
+
+    # heating request with the hysteresis band around the setpoint and the minimum time between changes
+    request = ~newforced & switch & ~intemperror
+    wanted = c["predicted"] < setpoint + numpy.where(heat, hysteresis["heat"], -hysteresis["heat"])
+    change = request & (wanted != heat)
+    heldheat = c["heatchanged"] + 60 * hysteresis["heat_hold"] > now
+    suppressed = change & heldheat
+    issued = change & ~heldheat
+    newheat = numpy.where(newforced, heat, request & numpy.where(suppressed, heat, wanted))
+    heatchanged = numpy.where(issued, now, c["heatchanged"])
+
+    events = numpy.select([off & (forced | switchheat), off, forcedon, forcedend, forcedmode, forcedoff, pauseoff, pauseon,
+                           night, scheduledeco, normal, reduced, eco, vacation],
+                          [plugin.DECISIONEVENTS.index(event) for event in
+                           ("off_heat", "off", "forced_on", "forced_end", "forced", "forced_off", "pause_off", "pause_on",
+                            "night", "scheduled_eco", "normal", "reduced", "eco", "vacation")],
+                          plugin.DECISIONEVENTS.index("auto"))
+
+    actions = []
+    for name, new, old in (("control", newcontrol, control), ("forced", newforced, forced), ("endheat", endheat, c["endheat"]),
+                           ("pause", newpause, pause), ("switchHeat", switch, switchheat), ("setpoint", setpoint, c["setpoint"]),
+                           ("TRVsetpoint", trvsetpoint, c["TRVsetpoint"]), ("TRVheld", trvheld, held),
+                           ("heat", newheat, c["heat"] != 0), ("heatchanged", heatchanged, c["heatchanged"])):
+        for index in numpy.flatnonzero(new != old).tolist():
+            value = new[index].item()
+            actions.append((index, name, int(value) if name in ("control", "TRVsetpoint") else value))
+    for name, mask in (("heat_issued", issued), ("heat_suppressed", suppressed)):
+        actions.extend((index, name, 1) for index in numpy.flatnonzero(mask).tolist())
+    actions.extend((index, "event", plugin.DECISIONEVENTS[code]) for index, code in enumerate(events.tolist()))
+    return actions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="SVT3 decision kernel benchmark")
+    parser.add_argument("--zones", type=int, default=500, help="number of zones decided in one pass")
+    parser.add_argument("--passes", type=int, default=20, help="passes to time")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    now = 1767600000.0
+    hysteresis = {"trv": 0.2, "trv_hold": 5.0, "heat": 0.1, "heat_hold": 2.0}
+    columns = plugin.DecisionColumns([randomzone(rng, now) for zone in range(args.zones)])
+
+    kernels = {"python": plugin.Decide}
+    if numpy is not None:
+        kernels["numpy"] = decidevectorized
+    results = {}
+    for name, kernel in kernels.items():
+        timings = []
+        for run in range(args.passes):
+            start = time.perf_counter()
+            actions = kernel(columns, now, hysteresis)
+            timings.append(1000 * (time.perf_counter() - start))
+        results[name] = sorted(actions)
+        print("{:6} kernel: {} zones, {} actions, mean {:.2f} ms, min {:.2f} ms per pass".format(
+            name, args.zones, len(actions), statistics.mean(timings), min(timings)))
+    if "numpy" in results:
+        print("same actions    : {}".format(results["python"] == results["numpy"]))
+    else:
+        print("NumPy not installed, only the pure Python kernel was run")
+
+
+if __name__ == "__main__":
+    main()
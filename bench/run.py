@@ -0,0 +1,291 @@
+"""
+Offline simulation and benchmark of the SVT3 plugin.
+
+Runs plugin.py against the fake Domoticz module and a local fake JSON API serving a device fleet,
+on a simulated clock, and reports heartbeat latency, API calls per cycle and memory:
+
+    python3 bench/run.py --devices 2000 --zones 20 --heaters 3 --cycles 200
+
+Extra plugin settings (same format as settings.json) can be given with --settings file.json.
+With --zigbee2mqtt, the TRV are also served by a local fake MQTT broker and zigbee2mqtt.
+With --budget file.json, the report is checked against the limits of the file and the exit status is 1
+when one is exceeded. bench/budget.json is recorded for:
+
+    python3 bench/run.py --zones 5 --cycles 200 --budget bench/budget.json
+"""
+import argparse
+import json
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+
+BENCHDIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BENCHDIR)
+sys.path.insert(1, os.path.dirname(BENCHDIR))
+
+import Domoticz  # the fake one from this folder
+from fakeapi import Fleet, FakeAPI
+from fakemqtt import FakeZigbee2Mqtt
+
+
+class SimClock:
+
+    # simulated wall clock and monotonic clock, moved forward by the bench only
+
+    def __init__(self, start=None):
+        self.start = start or datetime(2026, 1, 5, 6, 0, 0)
+        self.elapsed = 0.0
+
+    def advance(self, seconds):
+        self.elapsed += seconds
+
+    def now(self):
+        return self.start + timedelta(seconds=self.elapsed)
+
+    def monotonic(self):
+        return 1000.0 + self.elapsed
+
+
+def patchclock(plugin, clock):
+    # make plugin.py use the simulated clock for datetime.now() and time.monotonic()
+
+    class SimDatetime(datetime):
+        @classmethod
+        def now(cls, tz=None):
+            return cls.combine(clock.now().date(), clock.now().time())
+
+    class SimTime:
+        def __getattr__(self, name):
+            return getattr(time, name)
+
+        def monotonic(self):
+            return clock.monotonic()
+
+    plugin.datetime = SimDatetime
+    plugin.time = SimTime()
+
+
+def duewrites(writer, clock):
+    # writes waiting in the queue that the writer may send now (not waiting for a retry or the API circuit)
+    with writer.cond:
+        due = sum(1 for setpoint, attempts, notbefore in writer.pending.values() if notbefore <= clock.monotonic())
+        return due + (writer.inflight is not None)
+
+
+def percentile(values, percent):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * percent / 100))] if values else 0.0
+
+
+def overbudget(report, budget, prefix=""):
+    # (name, value, limit) of the report values above their limit, the budget has the layout of the report
+    over = []
+    for key, limit in budget.items():
+        value = report.get(key, 0)  # a call never made is not in the report
+        if isinstance(limit, dict):
+            over += overbudget(value if isinstance(value, dict) else {}, limit, prefix + key + ".")
+        elif value > limit:
+            over.append((prefix + key, value, limit))
+    return over
+
+
+def main():
+    parser = argparse.ArgumentParser(description="SVT3 offline benchmark")
+    parser.add_argument("--devices", type=int, default=500, help="number of devices in the installation")
+    parser.add_argument("--zones", type=int, default=1, help="number of thermostat zones (max 25)")
+    parser.add_argument("--heaters", type=int, default=2, help="TRV per zone")
+    parser.add_argument("--cycles", type=int, default=100, help="heartbeats to run")
+    parser.add_argument("--interval", type=float,
+                        help="simulated seconds between heartbeats (default: the heartbeat interval asked by the plugin)")
+    parser.add_argument("--commands", type=int, default=10, help="send a setpoint command every N cycles (0 = never)")
+    parser.add_argument("--settings", help="json file with extra plugin settings")
+    parser.add_argument("--budget", help="json file with the limits of the report values, exit status 1 if exceeded")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", action="store_true", help="print the report as json")
+    parser.add_argument("--verbose", action="store_true", help="print the plugin logs")
+    parser.add_argument("--history", help="export the history of the first zone to this csv file")
+    parser.add_argument("--outage", help="cycles FIRST-LAST during which the API answers HTTP 503")
+    parser.add_argument("--thermal", action="store_true",
+                        help="simulate the room temperatures from the heating requests and report the comfort")
+    parser.add_argument("--zigbee2mqtt", action="store_true",
+                        help="read and write the TRV through a local fake zigbee2mqtt broker instead of the API")
+    args = parser.parse_args()
+
+    random.seed(args.seed)  # the plugin draws its actuation intervals from the global generator
+    clock = SimClock()
+    fleet = Fleet(clock.now, devices=args.devices, zones=min(args.zones, 25), heaters=args.heaters, seed=args.seed)
+    server = FakeAPI(fleet)
+    port = server.start()
+    broker = FakeZigbee2Mqtt(fleet) if args.zigbee2mqtt else None
+
+    homefolder = tempfile.mkdtemp(prefix="svt3bench")
+    settings = {"writes": {"interval": 0, "backoff": 0}}
+    if args.history:
+        settings["history"] = {"enabled": True, "size": max(args.cycles, 10)}
+    if args.settings:
+        with open(args.settings, encoding="utf-8") as f:
+            for section, values in json.load(f).items():
+                if isinstance(values, dict):
+                    settings.setdefault(section, {}).update(values)
+                else:
+                    settings[section] = values
+    if broker:
+        settings["zigbee2mqtt"] = {"enabled": True, "port": broker.start(), "devices": broker.names()}
+    settings["zones"] = [{"name": "Zone {}".format(index),
+                          "inside": ",".join(map(str, layout["inside"])),
+                          "trv": ",".join(map(str, layout["trv"])),
+                          "heaters": ",".join(map(str, layout["heaters"])),
+                          "presence": ",".join(map(str, layout["presence"]))}
+                         for index, layout in enumerate(fleet.zones) if index > 0]
+    with open(os.path.join(homefolder, "settings.json"), "w", encoding="utf-8") as f:
+        json.dump(settings, f)
+
+    Domoticz.Echo = args.verbose
+    import plugin
+    patchclock(plugin, clock)
+    plugin._plugin = plugin.BasePlugin()  # built again on the simulated clock
+    first = fleet.zones[0]
+    plugin.Parameters = {"Address": "127.0.0.1", "Port": str(port), "Username": "", "Password": "",
+                         "Mode1": ",".join(map(str, first["inside"])), "Mode2": ",".join(map(str, first["trv"])),
+                         "Mode3": ",".join(map(str, first["heaters"])), "Mode4": ",".join(map(str, first["presence"])),
+                         "Mode5": "2,1,60,1,60,10,20", "Mode6": "Verbose" if args.verbose else "Normal",
+                         "HomeFolder": homefolder + os.sep, "HardwareID": 1, "Key": "SVT3", "Name": "SVT3 bench"}
+    plugin.Devices = Domoticz.Devices
+
+    tracemalloc.start()
+    plugin.onStart()
+    deadline = time.monotonic() + 5
+    while broker and not broker.connected() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    for unit, device in Domoticz.Devices.items():
+        if unit % 10 in (1, 2):
+            device.Update(nValue=1, sValue="10")  # thermostat on auto, normal mode
+        elif unit % 10 == 4:
+            device.Update(nValue=0, sValue="20")
+    # heartbeats until the plugin finds the devices ready and starts controlling
+    plugin.onHeartbeat()
+    while not plugin._plugin.started:
+        clock.advance(Domoticz.HeartbeatInterval)
+        plugin.onHeartbeat()
+    startup = clock.elapsed
+    clock.advance(Domoticz.HeartbeatInterval)
+    server.takecalls()
+
+    outage = tuple(map(int, args.outage.split("-"))) if args.outage else (-1, -1)
+    latencies = []
+    commands = []  # latency of the onCommand calls
+    calls = []
+    comfort = {"overshoot": 0.0, "undershoot": 0.0, "heating": 0.0}  # degree-hours and hours, all zones
+    for cycle in range(args.cycles):
+        interval = args.interval or Domoticz.HeartbeatInterval
+        if args.thermal:
+            requests = [Domoticz.Devices[10 * zone + 7].nValue for zone in range(len(fleet.zones))]
+            fleet.heat(interval, requests)
+            fleet.step(changes=0)
+            hours = interval / 3600
+            band = plugin._plugin.hysteresis["heat"]
+            for zone, room, request in zip(plugin._plugin.Zones, fleet.rooms, requests):
+                comfort["overshoot"] += max(0.0, room[0] - zone.setpoint - band) * hours
+                comfort["undershoot"] += max(0.0, zone.setpoint - band - room[0]) * hours
+                comfort["heating"] += room[1] * hours  # radiators at full heat
+        else:
+            fleet.step()
+        server.down = outage[0] <= cycle <= outage[1]
+        if broker:
+            broker.publish()
+            time.sleep(0.002)  # the states reach the plugin before its heartbeat, as they would between two heartbeats
+        if args.commands and cycle % args.commands == args.commands - 1:
+            unit = 10 * (cycle // args.commands % len(fleet.zones)) + 4
+            start = time.perf_counter()
+            plugin.onCommand(unit, "Set Level", 19.5 + cycle % 3, 0)
+            commands.append(1000 * (time.perf_counter() - start))
+        else:
+            start = time.perf_counter()
+            plugin.onHeartbeat()
+            latencies.append(1000 * (time.perf_counter() - start))
+        # let the background writer send the writes due at this time before counting the calls of this cycle
+        deadline = time.monotonic() + 5
+        while duewrites(plugin._plugin.writer, clock) and time.monotonic() < deadline:
+            time.sleep(0.001)
+        calls.append(server.takecalls())
+        clock.advance(interval)
+        with plugin._plugin.writer.cond:
+            plugin._plugin.writer.cond.notify()  # its waits are in real time, wake it on the new simulated time
+    # let the writes of the last commands go out before stopping
+    clock.advance(plugin._plugin.debounce)
+    with plugin._plugin.writer.cond:
+        plugin._plugin.writer.cond.notify()
+    deadline = time.monotonic() + 5
+    while duewrites(plugin._plugin.writer, clock) and time.monotonic() < deadline:
+        time.sleep(0.001)
+    current, peak = tracemalloc.get_traced_memory()
+    if args.history:
+        with open(args.history, "w", encoding="utf-8", newline="") as f:
+            plugin._plugin.Zones[0].history.export(f)
+    transport = plugin._plugin.zigbee2mqtt
+    plugin.onStop()
+    server.shutdown()
+    if broker:
+        broker.shutdown()
+
+    report = {
+        "zones": len(fleet.zones), "devices": len(fleet.devices), "cycles": args.cycles,
+        "simulated_hours": round(clock.elapsed / 3600, 2), "startup_seconds": startup,
+        "heartbeats_skipped": plugin._plugin.metrics.counters.get(("svt3_heartbeats_skipped_total", ()), 0),
+        "heartbeat_ms": {"mean": round(statistics.mean(latencies), 2), "p50": round(percentile(latencies, 50), 2),
+                         "p95": round(percentile(latencies, 95), 2), "max": round(max(latencies), 2)},
+        "command_ms": {"mean": round(statistics.mean(commands), 2) if commands else 0.0,
+                       "max": round(max(commands, default=0.0), 2)},
+        "api_calls_per_cycle": {param: round(sum(c[param] for c in calls) / len(calls), 2)
+                                for param in sorted(set().union(*calls))},
+        "api_calls_per_hour": {param: round(sum(c[param] for c in calls) / (clock.elapsed / 3600), 1)
+                               for param in sorted(set().union(*calls))},
+        "memory_kb": {"current": current // 1024, "peak": peak // 1024},
+        "log_lines": dict(Domoticz.Counts),
+        "api_calls_in_outage": sum(sum(c.values()) for cycle, c in enumerate(calls) if outage[0] <= cycle <= outage[1]),
+        "device_updates": sum(device.Updates for device in Domoticz.Devices.values()),
+        "comfort_per_zone": {key: round(value / len(fleet.zones), 2) for key, value in comfort.items()},
+    }
+    if transport:
+        report["zigbee2mqtt"] = {"published": transport.published, "received": transport.received,
+                                 "not_acknowledged": transport.pending(), "broker": dict(broker.messages) if broker else {}}
+    over = []
+    if args.budget:
+        with open(args.budget, encoding="utf-8") as f:
+            over = overbudget(report, {key: value for key, value in json.load(f).items() if not key.startswith("_")})
+    if args.json:
+        print(json.dumps(report, indent=2))
+        return 1 if over else 0
+    print("SVT3 bench: {zones} zones, {devices} devices, {cycles} cycles, {simulated_hours} simulated hours, "
+          "{heartbeats_skipped} heartbeats skipped".format(**report))
+    print("start-up s      : {}".format(report["startup_seconds"]))
+    print("heartbeat ms    : mean {mean}  p50 {p50}  p95 {p95}  max {max}".format(**report["heartbeat_ms"]))
+    if commands:
+        print("command ms      : mean {mean}  max {max}".format(**report["command_ms"]))
+    print("API calls/cycle : " + ", ".join("{} {}".format(k, v) for k, v in report["api_calls_per_cycle"].items()))
+    print("API calls/hour  : " + ", ".join("{} {}".format(k, v) for k, v in report["api_calls_per_hour"].items()))
+    print("memory kB       : current {current}  peak {peak}".format(**report["memory_kb"]))
+    print("log lines       : " + ", ".join("{} {}".format(k, v) for k, v in report["log_lines"].items()))
+    print("device updates  : {}".format(report["device_updates"]))
+    if args.outage:
+        print("calls in outage : {}".format(report["api_calls_in_outage"]))
+    if transport:
+        print("zigbee2mqtt     : {published} setpoints published, {received} states received, "
+              "{not_acknowledged} setpoints not acknowledged".format(**report["zigbee2mqtt"]))
+    if args.thermal:
+        print("comfort per zone: overshoot {overshoot} degree-hours, undershoot {undershoot} degree-hours, "
+              "radiators heat {heating} hours".format(**report["comfort_per_zone"]))
+    if args.budget:
+        for name, value, limit in over:
+            print("over budget     : {} {} > {}".format(name, value, limit))
+        print("budget          : {}".format("exceeded" if over else "ok"))
+    return 1 if over else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,387 @@
+"""
+Focused tests of the SVT3 building blocks, run against the fake Domoticz module of this folder:
+
+    python3 bench/test_plugin.py
+"""
+import gzip
+import io
+import os
+import sys
+import tempfile
+import threading
+import unittest
+from datetime import datetime, timedelta
+
+BENCHDIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BENCHDIR)
+sys.path.insert(1, os.path.dirname(BENCHDIR))
+
+import Domoticz  # the fake one from this folder
+import plugin
+from run import SimClock, patchclock
+
+MONDAY = datetime(2026, 1, 5)
+
+
+class ClockTest(unittest.TestCase):
+
+    # runs plugin.py on a simulated clock, restored after each test
+
+    def setUp(self):
+        self.saved = plugin.time, plugin.datetime
+        self.clock = SimClock(MONDAY)
+        patchclock(plugin, self.clock)
+
+    def tearDown(self):
+        plugin.time, plugin.datetime = self.saved
+
+
+class ScheduleTest(unittest.TestCase):
+
+    WEEK = {"default": [["07:00", "comfort"], ["22:00", "night"]],
+            "sat": [["09:00", "comfort"], ["23:00", "night"]],
+            "sun": []}
+
+    def test_day_starts_with_the_last_level_of_the_day_before(self):
+        schedule = plugin.Schedule(self.WEEK)
+        self.assertEqual(schedule.lookup(MONDAY + timedelta(hours=6)),
+                         ("night", MONDAY + timedelta(hours=7), "comfort"))
+        self.assertEqual(schedule.lookup(MONDAY + timedelta(hours=7)),
+                         ("comfort", MONDAY + timedelta(hours=22), "night"))
+
+    def test_empty_day_keeps_the_level_of_the_day_before(self):
+        schedule = plugin.Schedule(self.WEEK)
+        sunday = MONDAY + timedelta(days=6)
+        self.assertEqual(schedule.lookup(sunday + timedelta(hours=12)),
+                         ("night", sunday + timedelta(days=1, hours=7), "comfort"))
+
+    def test_holiday_follows_the_holiday_day(self):
+        wednesday = MONDAY + timedelta(days=2)
+        schedule = plugin.Schedule(self.WEEK, holidays=[wednesday.date().isoformat()], holiday="sat")
+        self.assertEqual(schedule.lookup(wednesday + timedelta(hours=8)),
+                         ("night", wednesday + timedelta(hours=9), "comfort"))
+
+    def test_recompiled_past_the_horizon(self):
+        schedule = plugin.Schedule(self.WEEK)
+        schedule.lookup(MONDAY)
+        later = MONDAY + timedelta(days=plugin.Schedule.HORIZON + 7, hours=8)
+        self.assertEqual(schedule.lookup(later)[0], "comfort")
+        self.assertLessEqual(schedule.times[0], later)
+
+    def test_invalid_timetables(self):
+        with self.assertRaises(ValueError):
+            plugin.Schedule({"default": [["07:00", "warm"]]})
+        with self.assertRaises(ValueError):
+            plugin.Schedule({})
+
+
+class CircuitBreakerTest(ClockTest):
+
+    def test_opens_after_threshold_failures(self):
+        breaker = plugin.CircuitBreaker(threshold=2, delay=10.0, jitter=0.0)
+        breaker.failure()
+        self.assertTrue(breaker.allow())
+        breaker.failure()
+        self.assertEqual(breaker.state, plugin.CircuitBreaker.OPEN)
+        self.assertFalse(breaker.allow())
+        self.assertEqual((breaker.opened, breaker.refused), (1, 1))
+        self.assertEqual(breaker.retryin(), 10.0)
+
+    def test_half_open_probe(self):
+        breaker = plugin.CircuitBreaker(threshold=1, delay=10.0, jitter=0.0)
+        breaker.failure()
+        self.clock.advance(10.0)
+        self.assertTrue(breaker.allow())  # the probe
+        self.assertEqual(breaker.state, plugin.CircuitBreaker.HALFOPEN)
+        self.assertFalse(breaker.allow())  # the others wait for its result
+        self.assertEqual(breaker.retryin(), 1.0)
+        breaker.failure()
+        self.assertEqual(breaker.opendelay, 20.0)  # twice the delay
+        self.clock.advance(20.0)
+        self.assertTrue(breaker.allow())
+        breaker.success()
+        self.assertEqual(breaker.state, plugin.CircuitBreaker.CLOSED)
+        self.assertEqual(breaker.retryin(), 0.0)
+
+    def test_delay_is_capped(self):
+        breaker = plugin.CircuitBreaker(threshold=1, delay=10.0, maxdelay=30.0, jitter=0.0)
+        for opening in range(4):
+            breaker.failure()
+            self.clock.advance(breaker.opendelay)
+            breaker.allow()
+        self.assertEqual(breaker.opendelay, 30.0)
+
+
+class FakeTransport:
+
+    # setsetpoint() of the WriteQueue, answering with the errors given in order then None
+
+    def __init__(self, errors=(), gate=None):
+        self.errors = list(errors)
+        self.gate = gate  # event the first write waits for, to queue a newer value while it is in flight
+        self.calls = []
+        self.started = threading.Event()
+        self.aborted = 0
+
+    def setsetpoint(self, idx, setpoint):
+        self.calls.append((idx, setpoint))
+        self.started.set()
+        if self.gate and len(self.calls) == 1:
+            self.gate.wait(5)
+        error = self.errors.pop(0) if self.errors else None
+        return (None, error) if error else ({"status": "OK"}, None)
+
+    def abort(self):
+        self.aborted += 1
+
+
+class WriteQueueTest(unittest.TestCase):
+
+    def run_queue(self, queue, writes):
+        queue.start()
+        for attempt in range(500):
+            if len(queue.results) >= writes:
+                break
+            threading.Event().wait(0.01)
+        queue.stop()
+        return queue.drain()
+
+    def test_newer_value_replaces_the_pending_one(self):
+        transport = FakeTransport()
+        queue = plugin.WriteQueue(transport, interval=0.0)
+        self.assertTrue(queue.put(11, 20.0))
+        self.assertFalse(queue.put(11, 20.0))  # already waiting
+        self.assertTrue(queue.put(11, 21.0))
+        self.assertEqual(queue.depth(), 1)
+        self.assertEqual(self.run_queue(queue, 1), [(11, 21.0, None)])
+        self.assertEqual((queue.sent, queue.coalesced, transport.calls), (1, 1, [(11, 21.0)]))
+
+    def test_retries_then_reports_the_failure(self):
+        transport = FakeTransport(errors=["down"] * 3)
+        queue = plugin.WriteQueue(transport, interval=0.0, retries=3, backoff=0.0)
+        queue.put(11, 20.0)
+        self.assertEqual(self.run_queue(queue, 1), [(11, 20.0, "down")])
+        self.assertEqual((len(transport.calls), queue.failed), (3, 1))
+
+    def test_superseded_failure_is_dropped(self):
+        gate = threading.Event()
+        transport = FakeTransport(errors=["down"], gate=gate)
+        queue = plugin.WriteQueue(transport, interval=0.0, retries=1)
+        queue.put(11, 20.0)
+        queue.start()
+        transport.started.wait(5)
+        queue.put(11, 21.0)  # while 20 is in flight
+        gate.set()
+        for attempt in range(500):
+            if queue.done():
+                break
+            threading.Event().wait(0.01)
+        queue.stop()
+        self.assertEqual(queue.drain(), [(11, 21.0, None)])
+        self.assertEqual(queue.failed, 0)
+
+    def test_stop_aborts_and_counts_the_unsent(self):
+        transport = FakeTransport()
+        queue = plugin.WriteQueue(transport)
+        queue.put(11, 20.0, delay=60.0)
+        queue.start()
+        self.assertEqual(queue.stop(), 1)
+        self.assertEqual((transport.calls, transport.aborted), ([], 1))
+
+
+class SensorHealthTest(unittest.TestCase):
+
+    NOW = MONDAY + timedelta(hours=12)
+
+    @staticmethod
+    def device(updated, timeout=False, hardware="Zigbee"):
+        return {"Name": "Sensor", "LastUpdate": updated.strftime("%Y-%m-%d %H:%M:%S"), "HaveTimeout": timeout,
+                "HardwareName": hardware}
+
+    def test_fresh_sensor_is_ok_without_change(self):
+        health = plugin.SensorHealth(stale=30)
+        self.assertTrue(health.check(1, self.device(self.NOW), self.NOW))
+        self.assertEqual(health.drain(), [])
+
+    def test_stale_then_recovering_then_ok(self):
+        health = plugin.SensorHealth(stale=30, recover=2)
+        health.check(1, self.device(self.NOW), self.NOW)
+        later = self.NOW + timedelta(minutes=31)
+        health.expire(later)
+        self.assertEqual(health.drain(), [(1, "Sensor", plugin.SensorHealth.STALE)])
+        self.assertFalse(health.check(1, self.device(later), later))
+        self.assertEqual(health.sensors[1].state, plugin.SensorHealth.RECOVERING)
+        later += timedelta(minutes=5)
+        self.assertTrue(health.check(1, self.device(later), later))
+        self.assertEqual(health.drain(), [(1, "Sensor", plugin.SensorHealth.RECOVERING),
+                                          (1, "Sensor", plugin.SensorHealth.OK)])
+
+    def test_read_again_before_expiry_stays_ok(self):
+        health = plugin.SensorHealth(stale=30)
+        health.check(1, self.device(self.NOW), self.NOW)
+        later = self.NOW + timedelta(minutes=20)
+        health.check(1, self.device(later), later)
+        health.expire(self.NOW + timedelta(minutes=40))
+        self.assertEqual(health.sensors[1].state, plugin.SensorHealth.OK)
+        self.assertEqual(health.sensors[1].interval, 1200.0)
+
+    def test_timed_out_except_dummies(self):
+        health = plugin.SensorHealth()
+        self.assertFalse(health.check(1, self.device(self.NOW, timeout=True), self.NOW))
+        self.assertTrue(health.check(2, self.device(self.NOW - timedelta(days=1), True, "Dummies"), self.NOW))
+        self.assertEqual(health.counts()[plugin.SensorHealth.TIMEDOUT], 1)
+
+    def test_failing_state_survives_a_restart(self):
+        health = plugin.SensorHealth()
+        health.check(1, self.device(self.NOW, timeout=True), self.NOW)
+        restarted = plugin.SensorHealth()
+        restarted.SetState(health.GetState())
+        self.assertFalse(restarted.check(1, self.device(self.NOW), self.NOW))
+        self.assertEqual(restarted.sensors[1].state, plugin.SensorHealth.RECOVERING)
+
+
+class PresenceTimelineTest(unittest.TestCase):
+
+    NOW = MONDAY + timedelta(hours=12)
+
+    @staticmethod
+    def stamp(when):
+        return when.strftime("%Y-%m-%d %H:%M:%S")
+
+    def test_on_then_off_keeps_the_window(self):
+        timeline = plugin.PresenceTimeline(window=30.0)
+        timeline.observe(1, True, self.stamp(self.NOW), self.NOW)
+        off = self.NOW + timedelta(seconds=60)
+        timeline.observe(1, False, self.stamp(off), off + timedelta(seconds=5))
+        self.assertTrue(timeline.occupied(off + timedelta(seconds=30)))
+        self.assertFalse(timeline.occupied(off + timedelta(seconds=31)))
+        self.assertEqual(timeline.until(off + timedelta(seconds=5)), off + timedelta(seconds=30))
+
+    def test_pulse_between_two_readings(self):
+        timeline = plugin.PresenceTimeline(window=30.0)
+        timeline.observe(1, False, self.stamp(self.NOW), self.NOW)
+        self.assertFalse(timeline.occupied(self.NOW))
+        later = self.NOW + timedelta(minutes=5)
+        timeline.observe(1, False, self.stamp(later - timedelta(minutes=1)), later)
+        self.assertTrue(timeline.occupied(later + timedelta(seconds=30)))
+
+    def test_pulses_disabled(self):
+        timeline = plugin.PresenceTimeline(window=30.0, pulses=False)
+        timeline.observe(1, False, self.stamp(self.NOW), self.NOW)
+        later = self.NOW + timedelta(minutes=5)
+        timeline.observe(1, False, self.stamp(later - timedelta(minutes=1)), later)
+        self.assertFalse(timeline.occupied(later))
+
+    def test_several_sensors_needed(self):
+        timeline = plugin.PresenceTimeline(window=30.0, sensors=2)
+        timeline.observe(1, True, self.stamp(self.NOW), self.NOW)
+        timeline.observe(2, False, self.stamp(self.NOW), self.NOW)
+        self.assertFalse(timeline.occupied(self.NOW))
+        self.assertEqual(timeline.until(self.NOW), self.NOW)
+        timeline.observe(2, True, self.stamp(self.NOW), self.NOW)
+        self.assertTrue(timeline.occupied(self.NOW))
+
+    def test_more_sensors_than_there_are(self):
+        timeline = plugin.PresenceTimeline(sensors=3)
+        self.assertFalse(timeline.occupied(self.NOW))
+        timeline.observe(1, True, "bad date", self.NOW)
+        self.assertTrue(timeline.occupied(self.NOW))
+
+
+class HistoryBufferTest(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.prefix = os.path.join(self.folder.name, "history")
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    def test_ring_keeps_the_last_records_in_order(self):
+        history = plugin.HistoryBuffer(4, self.prefix)  # at least 10
+        self.assertEqual(history.size, 10)
+        for record in range(15):
+            history.add(MONDAY.timestamp() + 60 * record, record, 0, 20, 21, 1, 0)
+        rows = list(history.rows())
+        self.assertEqual([row[1] for row in rows], list(range(5, 15)))
+        self.assertEqual([row[1] for row in history.rows(2)], [13, 14])
+
+    def test_flush_appends_per_day(self):
+        history = plugin.HistoryBuffer(10, self.prefix)
+        for record in range(15):
+            history.add((MONDAY - timedelta(minutes=5)).timestamp() + 60 * record, 19.0, 18.5, 20, 21, 0, 1)
+        self.assertEqual(history.unsaved, 5)
+        history.flush()
+        days = {}
+        for day in ("20260104", "20260105"):
+            with gzip.open("{}_{}.csv.gz".format(self.prefix, day), "rt", encoding="utf-8") as f:
+                days[day] = f.read().splitlines()
+        self.assertEqual([len(lines) for lines in days.values()], [6, 11])  # header and 5 + 10 records
+        self.assertEqual(days["20260105"][0], ",".join(plugin.HistoryBuffer.FIELDS))
+        self.assertEqual(days["20260105"][1], "2026-01-05T00:00:00,19.0,18.5,20.0,21.0,0,1")
+
+    def test_export(self):
+        history = plugin.HistoryBuffer(10, self.prefix)
+        history.add(MONDAY.timestamp(), 19.123, 18.5, 20, 21, 1, 0)
+        f = io.StringIO()
+        history.export(f)
+        self.assertEqual(f.getvalue().splitlines()[1], "2026-01-05T00:00:00,19.12,18.5,20.0,21.0,1,0")
+
+
+class DeviceCacheTest(ClockTest):
+
+    def setUp(self):
+        super().setUp()
+        self.devices = plugin.Devices = {1: Domoticz.Device(Unit=1)}
+
+    def test_unchanged_values_are_suppressed_until_refresh(self):
+        cache = plugin.DeviceCache(refresh=1800.0)
+        self.assertTrue(cache.update(1, 0, "20"))
+        self.assertFalse(cache.update(1, 0, "20"))
+        self.assertTrue(cache.update(1, 0, "20", TimedOut=1))
+        self.clock.advance(1800.0)
+        self.assertTrue(cache.update(1, 0, "20", TimedOut=True))
+        self.assertEqual((cache.written, cache.suppressed, self.devices[1].Updates), (3, 1, 3))
+
+    def test_invalidate(self):
+        cache = plugin.DeviceCache()
+        cache.update(1, 1, "10")
+        cache.invalidate(1)
+        self.assertTrue(cache.update(1, 1, "10"))
+
+
+class MqttPacketTest(unittest.TestCase):
+
+    @staticmethod
+    def publish(topic, payload, kind=0x30):
+        return plugin.MqttClient._packet(kind, plugin.MqttClient._string(topic) + payload)
+
+    def test_packets_split_and_together(self):
+        data = self.publish("a/b", b"x" * 200) + b"\xd0\x00"  # a 2 bytes length, then a PINGRESP
+        buffer = bytearray(data[:2])
+        self.assertIsNone(plugin.MqttClient.parsePacket(buffer))
+        buffer += data[2:50]
+        self.assertIsNone(plugin.MqttClient.parsePacket(buffer))
+        self.assertEqual(len(buffer), 50)  # nothing consumed before the packet is complete
+        buffer += data[50:]
+        kind, body = plugin.MqttClient.parsePacket(buffer)
+        self.assertEqual(plugin.MqttClient.parsePublish(kind, body), ("a/b", b"x" * 200))
+        self.assertEqual(plugin.MqttClient.parsePacket(buffer), (0xd0, b""))
+        self.assertEqual(buffer, bytearray())
+        self.assertIsNone(plugin.MqttClient.parsePacket(buffer))
+
+    def test_malformed_length(self):
+        with self.assertRaises(ValueError):
+            plugin.MqttClient.parsePacket(bytearray(b"\x30\xff\xff\xff\xff\x01"))
+
+    def test_publish_bodies(self):
+        parse = plugin.MqttClient.parsePublish
+        self.assertIsNone(parse(0x30, b"\x00"))  # no topic length
+        self.assertIsNone(parse(0x30, b"\x00\x05a/b"))  # topic cut
+        self.assertEqual(parse(0x30, b"\x00\x03a/b"), ("a/b", b""))
+        self.assertEqual(parse(0x32, b"\x00\x03a/b\x00\x07{}"), ("a/b", b"{}"))  # QoS 1 packet identifier
+        self.assertIsNone(parse(0x32, b"\x00\x03a/b\x00"))
+
+
+if __name__ == "__main__":
+    unittest.main()
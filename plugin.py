@@ -17,6 +17,10 @@ Version:    0.0.1: alpha
         <h3>Set-up and Configuration</h3>
     </description>
     <params>
+        <param field="Address" label="Domoticz IP Address" width="200px" required="true" default="127.0.0.1"/>
+        <param field="Port" label="Port" width="40px" required="true" default="8080"/>
+        <param field="Username" label="Username" width="200px" required="false" default=""/>
+        <param field="Password" label="Password" width="200px" required="false" default="" password="true"/>
         <param field="Mode1" label="Inside Temperature Sensors (csv list of idx)" width="100px" required="true" default="0"/>
         <param field="Mode2" label="TRV Temperature Sensors (csv list of idx)" width="100px" required="false" default=""/>
         <param field="Mode3" label="TRV Actuators (csv list of idx)" width="100px" required="true" default="0"/>
@@ -39,15 +43,27 @@ Version:    0.0.1: alpha
 """
 import Domoticz
 import json
+import os
 import urllib.parse as parse
-import urllib.request as request
+import http.client
 import random
-from datetime import datetime, timedelta
+from datetime import datetime, date, timedelta
 import time
 import base64
 import itertools
-import urllib.error as urlerror
+import threading
 import math
+import gzip
+import csv
+from array import array
+import bisect
+import heapq
+import socket
+import struct
+
+METRICSUNIT = 250  # text device of the metrics, out of the zones units
+HEARTBEAT = 20  # seconds between two heartbeats, before the adaptive heartbeat changes it
+
 
 class deviceparam:
 
@@ -57,22 +73,228 @@ class deviceparam:
         self.svalue = svalue
 
 
-class BasePlugin:
+class DeviceCache:
+
+    # Write-through cache of the plugin's own devices: the last nValue, sValue and TimedOut written per unit.
+    # update() only calls Device.Update() (a database write and the device events in Domoticz) when one of
+    # them changes, or every refresh seconds so that the device is not shown as timed out. The other calls
+    # are counted as suppressed.
+
+    def __init__(self, refresh=1800.0):
+        self.refresh = refresh
+        self.values = {}  # unit: (nValue, sValue, TimedOut, monotonic time of the write)
+        self.written = 0
+        self.suppressed = 0
+
+    def update(self, unit, nValue, sValue, TimedOut=0):
+        now = time.monotonic()
+        last = self.values.get(unit)
+        if last is not None and last[:3] == (nValue, sValue, int(TimedOut)) and now - last[3] < self.refresh:
+            self.suppressed += 1
+            return False
+        Devices[unit].Update(nValue=nValue, sValue=sValue, TimedOut=int(TimedOut))
+        self.values[unit] = (nValue, sValue, int(TimedOut), now)
+        self.written += 1
+        return True
+
+    def invalidate(self, unit):
+        # the device was changed out of the plugin
+        self.values.pop(unit, None)
+
+
+class PluginLog:
+
+    # Logging with per subsystem levels (api, temps, presence, actuation) and lazy formatting: the
+    # message is only formatted when it is written. An error identical to one already written is
+    # only written again after repeat seconds, with the count of the ones skipped in between.
+
+    LEVELS = {"Error": 0, "Normal": 1, "Verbose": 2, "Debug": 3}
+
+    def __init__(self, prefix="", parent=None):
+        self.prefix = prefix
+        # shared by the prefixed loggers
+        self.config = parent.config if parent else {"default": 1, "levels": {}, "debug": False, "repeat": 900.0, "errors": {}}
+
+    def prefixed(self, prefix):
+        return PluginLog(prefix, self)
+
+    def setup(self, default, levels, debug, repeat=900.0):
+        self.config["default"] = self.LEVELS.get(default, 1)
+        self.config["levels"] = {subsystem: self.LEVELS.get(level, 1) for subsystem, level in levels.items()}
+        self.config["debug"] = debug
+        self.config["repeat"] = repeat
+
+    def enabled(self, subsystem, level):
+        return self.config["levels"].get(subsystem, self.config["default"]) >= level
+
+    def debug(self, subsystem, message, *args):
+        if self.enabled(subsystem, 3):
+            # debug lines of a subsystem set to Debug are visible even without domoticz debugging
+            (Domoticz.Debug if self.config["debug"] else Domoticz.Log)(self.prefix + (message.format(*args) if args else message))
+
+    def verbose(self, subsystem, message, *args):
+        if self.enabled(subsystem, 2):
+            Domoticz.Log(self.prefix + (message.format(*args) if args else message))
+
+    def info(self, subsystem, message, *args):
+        if self.enabled(subsystem, 1):
+            Domoticz.Log(self.prefix + (message.format(*args) if args else message))
+
+    def status(self, subsystem, message, *args):
+        if self.enabled(subsystem, 1):
+            Domoticz.Status(self.prefix + (message.format(*args) if args else message))
+
+    def error(self, subsystem, message, *args):
+        message = self.prefix + (message.format(*args) if args else message)
+        errors = self.config["errors"]
+        now = time.monotonic()
+        last = errors.get(message)  # [last time written, count skipped since]
+        if last is not None and now - last[0] < self.config["repeat"]:
+            last[1] += 1
+            return
+        if len(errors) > 500:
+            # forget the errors not seen for a while
+            for key in [key for key, (when, count) in errors.items() if now - when >= self.config["repeat"]]:
+                del errors[key]
+        errors[message] = [now, 0]
+        if last is not None and last[1]:
+            message += " (repeated {} times)".format(last[1])
+        Domoticz.Error(message)
+
+
+Log = PluginLog()
+
+
+class Metrics:
+
+    # In process counters, gauges and histograms (with labels), written in the Prometheus text format.
+    # The API client feeds it from the write queue thread too, hence the lock.
+
+    BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)  # seconds
 
     def __init__(self):
+        self.counters = {}  # (name, labels): value
+        self.gauges = {}  # (name, labels): value
+        self.histograms = {}  # (name, labels): [count per bucket..., count, sum]
+        self.lock = threading.Lock()
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        with self.lock:
+            self.gauges[(name, tuple(sorted(labels.items())))] = value
+
+    def total(self, name, value, **labels):
+        # a counter kept by another part of the plugin, copied at dump time
+        with self.lock:
+            self.counters[(name, tuple(sorted(labels.items())))] = value
+
+    def observe(self, name, seconds, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = [0] * (len(self.BUCKETS) + 1) + [0.0]
+            for position, bound in enumerate(self.BUCKETS):
+                if seconds <= bound:
+                    histogram[position] += 1
+            histogram[-2] += 1
+            histogram[-1] += seconds
+
+    def timer(self, name, **labels):
+        return MetricsTimer(self, name, labels)
+
+    def prometheus(self):
+        lines = []
+        with self.lock:
+            for kind, values in (("counter", self.counters), ("gauge", self.gauges)):
+                for name in sorted({name for name, labels in values}):
+                    lines.append("# TYPE {} {}".format(name, kind))
+                    for (metric, labels), value in sorted(values.items()):
+                        if metric == name:
+                            lines.append("{}{} {}".format(name, FormatLabels(labels), value))
+            for name in sorted({name for name, labels in self.histograms}):
+                lines.append("# TYPE {} histogram".format(name))
+                for (metric, labels), histogram in sorted(self.histograms.items()):
+                    if metric != name:
+                        continue
+                    for bound, count in zip(self.BUCKETS + ("+Inf",), histogram):
+                        lines.append("{}_bucket{} {}".format(name, FormatLabels(labels + (("le", bound),)), count))
+                    lines.append("{}_sum{} {:.6f}".format(name, FormatLabels(labels), histogram[-1]))
+                    lines.append("{}_count{} {}".format(name, FormatLabels(labels), histogram[-2]))
+        return "\n".join(lines) + "\n"
+
+    def summary(self):
+        # short text for the metrics text device
+        with self.lock:
+            heartbeat = self.histograms.get(("svt3_heartbeat_seconds", ()))
+            calls = sum(histogram[-2] for (name, labels), histogram in self.histograms.items()
+                        if name == "svt3_api_call_seconds")
+            errors = sum(value for (name, labels), value in self.counters.items() if name == "svt3_api_errors_total")
+            writes = self.counters.get(("svt3_trv_writes_total", ()), 0)
+        average = 1000 * heartbeat[-1] / heartbeat[-2] if heartbeat else 0
+        return "heartbeat {:.0f} ms - API {} calls, {} errors - TRV writes {}".format(average, calls, errors, writes)
+
+
+class MetricsTimer:
+
+    # context manager observing the duration of its block
+
+    def __init__(self, metrics, name, labels):
+        self.metrics = metrics
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.metrics.observe(self.name, time.perf_counter() - self.start, **self.labels)
+        return False
+
+
+def FormatLabels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(key, str(value).replace('"', '\\"')) for key, value in labels) + "}"
+
+
+class Zone:
+
+    # One thermostat zone: its sensors, TRV and presence detectors, its state and its block of
+    # devices (units 1-8 for the first zone, 11-18 for the second one, and so on).
+
+    # attributes kept in the state file across restarts: the state file is written when the forced mode, pause,
+    # presence or sensors health change. The readings and last actuations (and the learnt rates) are only
+    # written with them or every state.interval minutes
+    STATEKEYS = ("forced", "endheat", "pause", "pauserequested", "pauserequestchangedtime", "Presence",
+                 "PresenceTH", "presencechangedtime", "sensorhealth")
+    PERIODICKEYS = ("intemp", "TRVtemp", "smoothedtemps", "setpoint", "TRVsetpointsent", "TRVsentsetpoint", "TRVchangedtime",
+                    "heatchangedtime")
+
+    def __init__(self, plugin, index, name, insensors, trvsensors, heaters, presence, params):
 
         now = datetime.now()  # Time helper
 
-        self.debug = False
+        self.plugin = plugin
+        self.index = index
+        self.name = name
+        self.log = Log.prefixed("" if index == 0 else "[{}] ".format(name))
+        self.unitbase = 10 * index
         self.pauseondelay = 2  # time between pause sensor actuation and actual pause
         self.pauseoffdelay = 1  # time between end of pause sensor actuation and end of actual pause
         self.forcedduration = 60  # time in minutes for the forced mode
-        self.ActiveSensors = {}
-        self.InTempSensors = []
-        self.TRVTempSensors = []
+        self.InTempSensors = parseCSV(insensors)
+        self.TRVTempSensors = parseCSV(trvsensors)
+        self.TempSensors = list(dict.fromkeys(itertools.chain(self.InTempSensors, self.TRVTempSensors)))
+        self.InTempSet = set(self.InTempSensors)
         self.OutTempSensors = []
         self.switchHeat = False
-        self.Heaters = []
+        self.Heaters = parseCSV(heaters)
         self.heat = False
         self.pause = False
         self.pauserequested = False
@@ -84,139 +306,157 @@ class BasePlugin:
         self.outtemp = 20.0
         self.setpoint = 20.0
         self.TRVsetpoint = 20.0
+        self.TRVsetpointsent = None  # last setpoint sent to the TRV
+        self.TRVsentsetpoint = None  # zone setpoint for which it was computed, see CorrectedSetpoint()
+        self.TRVchangedtime = now
+        self.TRVheld = False
+        self.heatchangedtime = now - timedelta(days=1)
         self.endheat = now
-        self.nexttemps = now
+        self.nexttemps = now - timedelta(minutes=5)
         self.temptimeout = now
-        self.DTpresence = []
+        self.DTpresence = parseCSV(presence)
         self.Presencemode = False
         self.Presence = False
         self.PresenceTH = False
         self.presencechangedtime = now
         self.PresenceDetected = False
-        self.DTtempo = now
+        self.presencetimeline = PresenceTimeline(plugin.presence["window"], plugin.presence["sensors"],
+                                                 plugin.presence["pulses"])
         self.presenceondelay = 1  # time between first detection and last detection before turning presence ON
         self.presenceoffdelay = 60  # time between last detection before turning presence OFF
         self.reducjour = 10  # reduction de la temp par rapport a la consigne
         self.reducnuit = 20  # reduction de la temp par rapport a la consigne
         self.learn = True
-        self.RefreshAndActTime = now
-        self.NextInterval = random.randint(60, 90)
-        self.PLUGINstarteddtime = now
+        self.model = ThermalModel(plugin.predictive["forgetting"])
+        self.learnsample = None  # (time, inside temperature, radiators heat) of the last learning sample
+        self.radiator = 0.0  # radiators heat, see learnRates()
         self.DTexcludedUntil = {}
-        self.TempExcludedUntil = {}
-        return
+        self.sensorhealth = SensorHealth(plugin.health["stale"], plugin.health["recover"])
+        self.smoothedtemps = {}  # "in" / "trv": smoothed temperature
+        self.history = None
+        self.schedule = None
+        self.nextschedule = None  # time of the next change of the schedule level
+        self.preheating = None  # change of the schedule level started early
+        self.tempsdirty = True
+        self.presencedirty = False
+
+        Domoticz.Debug("Zone '{}': Inside Temperature sensors = {}".format(name, self.InTempSensors))
+        Domoticz.Debug("Zone '{}': TRV Temperature sensors = {}".format(name, self.TRVTempSensors))
+        Domoticz.Debug("Zone '{}': Heaters = {}".format(name, self.Heaters))
+        Domoticz.Debug("Zone '{}': DTpresence = {}".format(name, self.DTpresence))
 
+        # splits additional parameters
+        params = parseCSV(params)
+        if len(params) == 7:
+            self.pauseondelay = CheckParam("Pause On Delay", params[0], 2)
+            self.pauseoffdelay = CheckParam("Pause Off Delay", params[1], 0)
+            self.forcedduration = CheckParam("Forced Mode Duration", params[2], 60)
+            if self.forcedduration < 30:
+                Domoticz.Error("Invalid forced mode duration parameter. Using minimum of 30 minutes !")
+                self.calculate_period = 30
+            self.presenceondelay = CheckParam("Presence On Delay", params[3], 1)
+            self.presenceoffdelay = CheckParam("Presence Off Delay",params[4],30)
+            self.reducjour = CheckParam("reduit jour",params[5],10)
+            self.reducnuit = CheckParam("reduit nuit",params[6],20)
+        else:
+            Domoticz.Error("Error reading Mode5 parameters")
 
-    def onStart(self):
 
-        # setup the appropriate logging level
-        try:
-            debuglevel = int(Parameters["Mode6"])
-        except ValueError:
-            debuglevel = 0
-            self.loglevel = Parameters["Mode6"]
-        if debuglevel != 0:
-            self.debug = True
-            Domoticz.Debugging(debuglevel)
-            DumpConfigToLog()
-            self.loglevel = "Verbose"
-        else:
-            self.debug = False
-            Domoticz.Debugging(0)
+    def GetState(self, keys=STATEKEYS):
+
+        state = {}
+        for key in keys:
+            value = getattr(self, key)
+            if isinstance(value, datetime):
+                value = {"datetime": value.isoformat()}
+            elif key == "sensorhealth":
+                value = value.GetState()
+            state[key] = value
+        return state
+
+
+    def SetState(self, state):
+
+        for key in self.STATEKEYS + self.PERIODICKEYS:
+            if key not in state:
+                continue
+            value = state[key]
+            if isinstance(value, dict) and "datetime" in value:
+                value = datetime.fromisoformat(value["datetime"])
+            elif key == "sensorhealth":
+                self.sensorhealth.SetState(value)
+                continue
+            setattr(self, key, value)
+
+
+    def Dev(self, unit):
+
+        return Devices[self.unitbase + unit]
+
+
+    def updateDev(self, unit, nValue, sValue, TimedOut=0):
+
+        return self.plugin.devicecache.update(self.unitbase + unit, nValue, sValue, TimedOut)
+
+
+    def CreateDevices(self):
 
         # create the child devices if these do not exist yet
+        prefix = "" if self.index == 0 else self.name + " "
+        base = self.unitbase
         devicecreated = []
-        if 1 not in Devices:
+        if base + 1 not in Devices:
             Options = {"LevelActions": "||",
                        "LevelNames": "Off|Auto|Forced",
                        "LevelOffHidden": "false",
                        "SelectorStyle": "0"}
-            Domoticz.Device(Name="Thermostat Control", Unit=1, TypeName="Selector Switch", Switchtype=18, Image=15,
+            Domoticz.Device(Name=prefix + "Thermostat Control", Unit=base + 1, TypeName="Selector Switch", Switchtype=18, Image=15,
                             Options=Options, Used=1).Create()
-            devicecreated.append(deviceparam(1, 0, "0"))  # default is Off state
-        if 2 not in Devices:
+            devicecreated.append(deviceparam(base + 1, 0, "0"))  # default is Off state
+        if base + 2 not in Devices:
             Options = {"LevelActions": "||",
                        "LevelNames": "Off|Normal|Economy|Vacation",
                        "LevelOffHidden": "true",
                        "SelectorStyle": "0"}
-            Domoticz.Device(Name="Thermostat Mode", Unit=2, TypeName="Selector Switch", Switchtype=18, Image=15,
+            Domoticz.Device(Name=prefix + "Thermostat Mode", Unit=base + 2, TypeName="Selector Switch", Switchtype=18, Image=15,
                             Options=Options, Used=1).Create()
-            devicecreated.append(deviceparam(2, 0, "10"))  # default is normal confort mode
-        if 3 not in Devices:
-            Domoticz.Device(Name="Thermostat Pause", Unit=3, TypeName="Switch", Image=9, Used=1).Create()
-            devicecreated.append(deviceparam(3, 0, ""))  # default is Off
-        if 4 not in Devices:
-            Domoticz.Device(Name="Setpoint Normal", Unit=4, Type=242, Subtype=1, Used=1).Create()
-            devicecreated.append(deviceparam(4, 0, "20"))  # default is 20 degrees
-        if 5 not in Devices:
-            Domoticz.Device(Name="Setpoint Economy", Unit=5, Type=242, Subtype=1).Create()
-            devicecreated.append(deviceparam(5 ,0, "18"))  # default is 18 degrees
-        if 6 not in Devices:
-            Domoticz.Device(Name="Thermostat temp", Unit=6, TypeName="Temperature", Used=1).Create()
-            devicecreated.append(deviceparam(6, 0, "20"))  # default is 20 degrees
-        if 7 not in Devices:
-            Domoticz.Device(Name="Heating Request", Unit=7, TypeName="Switch", Image=9, Used=1).Create()
-            devicecreated.append(deviceparam(7, 0, ""))  # default is Off
-        if 8 not in Devices:
-            Domoticz.Device(Name="Presence sensor", Unit=8, TypeName="Switch", Image=9).Create()
-            devicecreated.append(deviceparam(8, 0, ""))  # default is Off
-
-        # if any device has been created in onStart(), now is time to update its defaults
+            devicecreated.append(deviceparam(base + 2, 0, "10"))  # default is normal confort mode
+        if base + 3 not in Devices:
+            Domoticz.Device(Name=prefix + "Thermostat Pause", Unit=base + 3, TypeName="Switch", Image=9, Used=1).Create()
+            devicecreated.append(deviceparam(base + 3, 0, ""))  # default is Off
+        if base + 4 not in Devices:
+            Domoticz.Device(Name=prefix + "Setpoint Normal", Unit=base + 4, Type=242, Subtype=1, Used=1).Create()
+            devicecreated.append(deviceparam(base + 4, 0, "20"))  # default is 20 degrees
+        if base + 5 not in Devices:
+            Domoticz.Device(Name=prefix + "Setpoint Economy", Unit=base + 5, Type=242, Subtype=1).Create()
+            devicecreated.append(deviceparam(base + 5 ,0, "18"))  # default is 18 degrees
+        if base + 6 not in Devices:
+            Domoticz.Device(Name=prefix + "Thermostat temp", Unit=base + 6, TypeName="Temperature", Used=1).Create()
+            devicecreated.append(deviceparam(base + 6, 0, "20"))  # default is 20 degrees
+        if base + 7 not in Devices:
+            Domoticz.Device(Name=prefix + "Heating Request", Unit=base + 7, TypeName="Switch", Image=9, Used=1).Create()
+            devicecreated.append(deviceparam(base + 7, 0, ""))  # default is Off
+        if base + 8 not in Devices:
+            Domoticz.Device(Name=prefix + "Presence sensor", Unit=base + 8, TypeName="Switch", Image=9).Create()
+            devicecreated.append(deviceparam(base + 8, 0, ""))  # default is Off
+
+        # if any device has been created, now is time to update its defaults
         for device in devicecreated:
             Devices[device.unit].Update(nValue=device.nvalue, sValue=device.svalue)
 
-        # build lists of sensors and switches
-        self.InTempSensors = parseCSV(Parameters["Mode1"])
-        Domoticz.Debug("Inside Temperature sensors = {}".format(self.InTempSensors))
-        self.TRVTempSensors = parseCSV(Parameters["Mode2"])
-        Domoticz.Debug("TRV Temperature sensors = {}".format(self.TRVTempSensors))
-        self.Heaters = parseCSV(Parameters["Mode3"])
-        Domoticz.Debug("Heaters = {}".format(self.Heaters))
-        self.DTpresence = parseCSV(Parameters["Mode4"])
-        Domoticz.Debug("DTpresence = {}".format(self.DTpresence))
-
-        # build dict of status of all temp sensors to be used when handling timeouts
-        for sensor in itertools.chain(self.InTempSensors, self.TRVTempSensors):
-            self.ActiveSensors[sensor] = True
-
-        # splits additional parameters
-        params = parseCSV(Parameters["Mode5"])
-        if len(params) == 7:
-            self.pauseondelay = CheckParam("Pause On Delay", params[0], 2)
-            self.pauseoffdelay = CheckParam("Pause Off Delay", params[1], 0)
-            self.forcedduration = CheckParam("Forced Mode Duration", params[2], 60)
-            if self.forcedduration < 30:
-                Domoticz.Error("Invalid forced mode duration parameter. Using minimum of 30 minutes !")
-                self.calculate_period = 30
-            self.presenceondelay = CheckParam("Presence On Delay", params[3], 1)
-            self.presenceoffdelay = CheckParam("Presence Off Delay",params[4],30)
-            self.reducjour = CheckParam("reduit jour",params[5],10)
-            self.reducnuit = CheckParam("reduit nuit",params[6],20)
-        else:
-            Domoticz.Error("Error reading Mode5 parameters")
-
         # if mode = off then make sure actual heating is off just in case if was manually set to on
-        if Devices[1].sValue == "0":
+        if self.Dev(1).sValue == "0":
             self.switchHeat = False
 
-        # Set domoticz heartbeat to 20 s (onheattbeat() will be called every 20 )
-        Domoticz.Heartbeat(20)
-
-        # reset time info when starting the plugin.
-        self.PLUGINstarteddtime = datetime.now()
-        self.nexttemps = datetime.now()- timedelta(minutes=5)
-
 
-    def onStop(self):
+    def DevicesOK(self):
 
-        Domoticz.Debugging(0)
+        return all(self.unitbase + unit in Devices for unit in (1,2,3,4,5,6,7,8))
 
 
-    def onCommand(self, Unit, Command, Level, Color):
-
-        Domoticz.Debug("onCommand called for Unit {}: Command '{}', Level: {}".format(Unit, Command, Level))
+    def onCommand(self, unit, Command, Level):
 
-        if Unit == 3:  # pause switch
+        if unit == 3:  # pause switch
             self.pauserequestchangedtime = datetime.now()
             svalue = ""
             if str(Command) == "On":
@@ -230,248 +470,333 @@ class BasePlugin:
             nvalue = 1 if Level > 0 else 0
             svalue = str(Level)
 
-        Devices[Unit].Update(nValue=nvalue, sValue=svalue)
-
-        if Unit in (1, 2, 4, 5): # truc
-            self.onHeartbeat()
+        self.updateDev(unit, nvalue, svalue)
 
 
-    def onHeartbeat(self):
+    def onDeviceModified(self, unit):
 
+        # our own pause switch may be changed by scripts without going through onCommand
+        if unit == 3:
+            pauserequested = self.Dev(3).nValue == 1
+            if pauserequested != self.pauserequested:
+                self.pauserequested = pauserequested
+                self.pauserequestchangedtime = datetime.now()
 
-        now = datetime.now()
-        # fool proof checking.... based on users feedback
-        if not all(device in Devices for device in (1,2,3,4,5,6,7,8)):
-            Domoticz.Error("one or more devices required by the plugin is/are missing, please check domoticz device creation settings and restart !")
-            return
-
-        if not self.PLUGINstarteddtime + timedelta(minutes=2) <= now:
-            Domoticz.Log( "---> Plugin starting.... Wait a while")  # we wait for Zigbee plugin starting well and all others needed...
-            return
-        else : # Plugin really started.....
-            # update temp
-            if self.nexttemps + timedelta(minutes=2) <= now:
-                self.readTemps()
-
-        if Devices[1].sValue == "0":  # Thermostat is off
-            Domoticz.Log("Thermostat is OFF")
-            Domoticz.Debug("TRV Calculded setpoint is : 7 because of thermostat off")
-            self.TRVsetpoint = 7
-            if not Devices[7].nValue == 0:
-                Devices[7].Update(nValue=0, sValue=Devices[7].sValue)
-
-            if self.forced or self.switchHeat:  # thermostat setting was just changed so we kill the heating
-                self.forced = False
-                self.switchHeat = False
-                Domoticz.Debug("Switching heat Off !")
-
-
-        elif Devices[1].sValue == "20":  # Thermostat is in forced mode
-            Domoticz.Log("Thermostat is in FORCED mode")
-
-            if self.forced:
-                if self.endheat <= now:
-                    self.forced = False
-                    self.endheat = now
-                    Domoticz.Debug("Forced mode Off after timer !")
-                    Devices[1].Update(nValue=1, sValue="10")  # set thermostat to normal mode
-                    self.switchHeat = False
-                    self.TRVsetpoint = math.ceil(self.setpoint - (self.intemp - self.TRVtemp))  # correction of TRV setpoint using difference between real indoor temp and mesured trv temp.
-                    Domoticz.Debug("TRV Calculded setpoint is : " + str(self.TRVsetpoint))
-                    if not Devices[7].nValue == 0:
-                        Devices[7].Update(nValue = 0,sValue = Devices[7].sValue)
-            else:
-                self.forced = True
-                self.endheat = now + timedelta(minutes=self.forcedduration)
-                Domoticz.Debug("Forced mode On !")
-                self.switchHeat = True
-                Domoticz.Debug("TRV Calculded setpoint is : 28")
-                self.TRVsetpoint = 28
-                if Devices[7].nValue == 0:
-                    Devices[7].Update(nValue = 1,sValue = Devices[7].sValue)
-
-        else:  # Thermostat is in mode auto
-            Domoticz.Debug("Thermostat is in AUTO mode")
-
-            if self.forced:  # thermostat setting was just changed from "forced" so we kill the forced mode
-                Domoticz.Debug("Forced mode Off !")
-                self.forced = False
-                self.switchHeat = True
-                self.TRVsetpoint = math.ceil(self.setpoint - (self.intemp - self.TRVtemp))   # correction of TRV setpoint using difference between real indoor temp and mesured trv temp.
-                Domoticz.Debug("TRV Calculded setpoint is : " + str(self.TRVsetpoint))
-                if not Devices[7].nValue == 0:
-                    Devices[7].Update(nValue = 0,sValue = Devices[7].sValue)
-
-            elif self.pause and not self.pauserequested:  # we are in pause and the pause switch is now off
-                if self.pauserequestchangedtime + timedelta(minutes=self.pauseoffdelay) <= now:
-                    Domoticz.Debug("Pause is now Off")
-                    self.pause = False
-                    self.switchHeat = True
-                    self.TRVsetpoint = math.ceil(self.setpoint - (self.intemp - self.TRVtemp))  # correction of TRV setpoint using difference between real indoor temp and mesured trv temp.
-                    Domoticz.Debug("TRV Calculded setpoint is : " + str(self.TRVsetpoint))
-
-            elif not self.pause and self.pauserequested:  # we are not in pause and the pause switch is now on
-                if self.pauserequestchangedtime + timedelta(minutes=self.pauseondelay) <= now:
-                    Domoticz.Debug("Pause is now On")
-                    self.pause = True
-                    self.switchHeat = False
-                    Domoticz.Debug("TRV Calculded setpoint is : 7")
-                    self.TRVsetpoint = 7
-                    if not Devices[7].nValue == 0:
-                        Devices[7].Update(nValue = 0,sValue = Devices[7].sValue)
-
-            else: # thermostart is ok in auto mode
-
-                self.switchHeat = True
-
-                # make current setpoint used in calculation reflect the select mode (10= normal, 20 = economy)
-
-                if Devices[2].sValue == "10":  # Mode Auto
-                    if self.PresenceTH:
-                        self.setpoint = float(Devices[4].sValue)
-                        Domoticz.Log("AUTO Mode - used setpoint is NORMAL : " + str(self.setpoint))
-                        self.TRVsetpoint = math.ceil(self.setpoint - (self.intemp - self.TRVtemp))   # correction of TRV setpoint using difference between real indoor temp and mesured trv temp.
-                        Domoticz.Debug("TRV Calculded setpoint is : " + str(self.TRVsetpoint))
 
-                    else:
-                        self.setpoint = (float(Devices[4].sValue) - ((self.reducjour) / 10))
-                        Domoticz.Log("AUTO Mode - used setpoint is reducted one : " + str(self.setpoint))
-                        self.TRVsetpoint = math.ceil(self.setpoint - (self.intemp - self.TRVtemp))   # correction of TRV setpoint using difference between real indoor temp and mesured trv temp.
-                        Domoticz.Debug("TRV Calculded setpoint is : " + str(self.TRVsetpoint))
+    def onHeartbeat(self, now):
 
-                elif Devices[2].sValue == "20":  # Mode ECO
-                    self.setpoint = float(Devices[5].sValue)
-                    Domoticz.Log("ECO Mode - used setpoint is ECO one : " + str(self.setpoint))
-                    self.TRVsetpoint = math.ceil(self.setpoint - (self.intemp - self.TRVtemp))   # correction of TRV setpoint using difference between real indoor temp and mesured trv temp.
-                    Domoticz.Debug("TRV Calculded setpoint is : " + str(self.TRVsetpoint))
+        # update temp: a reading brought forward by values pushed in the snapshot does not read the API again
+        due = self.nexttemps + timedelta(minutes=self.plugin.tempsrefresh) <= now
+        if self.tempsdirty or due:
+            with self.plugin.metrics.timer("svt3_phase_seconds", phase="readTemps"):
+                self.readTemps(None if due else self.plugin.tempsrefresh * 60)
+        if self.plugin.eventsmode:
+            # presence comes from the (cached) snapshot, so it is cheap to evaluate at every heartbeat
+            with self.plugin.metrics.timer("svt3_phase_seconds", phase="PresenceDetection"):
+                self.PresenceDetection()
+            self.presencedirty = False
 
-                else:
-                    self.setpoint = 15  # Mode Vacances
-                    Domoticz.Log("VACATION Mode - used setpoint is VACATION one : " + str(self.setpoint))
-                    self.TRVsetpoint = math.ceil(self.setpoint - (self.intemp - self.TRVtemp))   # correction of TRV setpoint using difference between real indoor temp and mesured trv temp.
-                    Domoticz.Debug("TRV Calculded setpoint is : " + str(self.TRVsetpoint))
-
-
-        # we check if not int temp error and if heating is requested and turn on or off the heating request device
-        if not self.forced:
-            if not self.intemperror :
-                if self.switchHeat and self.intemp < self.setpoint:
-                    if Devices[7].nValue == 0:
-                        Devices[7].Update(nValue = 1,sValue = Devices[7].sValue)
-                else:
-                    if not Devices[7].nValue == 0:
-                        Devices[7].Update(nValue = 0,sValue = Devices[7].sValue)
-            else:
-                if not Devices[7].nValue == 0:
-                    Devices[7].Update(nValue = 0,sValue = Devices[7].sValue)
 
+    def onActuate(self, now, actuate):
 
-        if self.RefreshAndActTime + timedelta(seconds=self.NextInterval) <= now:
-            # reset timer
-            self.RefreshAndActTime = now
-            # on redéfinit un nouvel intervalle pour le prochain tour
-            self.NextInterval = random.randint(60, 90)
-            Domoticz.Debug("Action déclenchée (prochain déclenchement dans {}s)".format(self.NextInterval))
+        if actuate:
             # refresh values and act
-            self.PresenceDetection()
+            if not self.plugin.eventsmode:
+                with self.plugin.metrics.timer("svt3_phase_seconds", phase="PresenceDetection"):
+                    self.PresenceDetection()
             # we update the TRV Setpoint
             self.TRVsetpoint = round(self.TRVsetpoint)  # on arrondi au setpoint sans virgule
-            Domoticz.Log("TRV Calculded setpoint is : " + str(self.TRVsetpoint))
-            # mise à jour uniquement si nécessaire
-            # mise à jour des TRV uniquement si nécessaire
-            for idx in self.Heaters:
-                # Récupérer les infos du device TRV via l'API Domoticz
-                deviceAPI = DomoticzAPI("type=command&param=getdevices&rid={}".format(idx))
-                if (not deviceAPI) or ("result" not in deviceAPI) or (len(deviceAPI["result"]) == 0):
-                    Domoticz.Error("Heater idx {} not found in Domoticz (API)".format(idx))
-                    continue
-
-                dev = deviceAPI["result"][0]
-
-                # Selon le type, la consigne peut être dans SetPoint, Data ou sValue
-                val_str = dev.get("SetPoint") or dev.get("Data") or dev.get("sValue")
+            self.TRVsentsetpoint = self.setpoint
+            if self.TRVsetpoint != self.TRVsetpointsent:
+                self.TRVsetpointsent = self.TRVsetpoint
+                self.TRVchangedtime = now
+            elif self.TRVheld:
+                self.plugin.actuation["trv_suppressed"] += len(self.Heaters)
+            self.log.verbose("actuation", "TRV Calculded setpoint is : {}", self.TRVsetpoint)
+            with self.plugin.metrics.timer("svt3_phase_seconds", phase="heaters"):
+                self.updateHeaters()
+
+        # keep the values of this cycle in the history
+        if self.history:
+            self.history.add(now.timestamp(), self.intemp, self.TRVtemp, self.setpoint, self.TRVsetpoint,
+                             self.PresenceTH, self.Dev(7).nValue)
+
+    def onCommandUpdate(self, now):
+
+        # fast path of a thermostat command: the new setpoint is computed on the last readings and the
+        # TRV writes are queued after a short delay, so that several quick clicks make only one write.
+        # The TRV and sensors are read again at the next heartbeat.
+        self.plugin.UpdateModes([self], now)
+        self.TRVsetpoint = round(self.TRVsetpoint)
+        self.TRVsentsetpoint = self.setpoint
+        if self.TRVsetpoint == self.TRVsetpointsent:
+            return
+        self.TRVsetpointsent = self.TRVsetpoint
+        self.TRVchangedtime = now
+        self.log.verbose("actuation", "TRV Calculded setpoint is : {}", self.TRVsetpoint)
+        for idx in self.Heaters:
+            if self.plugin.writer.put(idx, self.TRVsetpoint, delay=self.plugin.debounce):
+                self.plugin.actuation["trv_issued"] += 1
+                self.plugin.metrics.inc("svt3_trv_writes_total")
+                self.log.info("actuation", "Update TRV idx {} to {}", idx, self.TRVsetpoint)
+
+    # Decision functions ---------------------------------------------------
+    def decisionInputs(self, now):
+
+        # state of the zone for the decision kernel, in the order of DECISIONFIELDS
+        mode = MODECODES.get(self.Dev(2).sValue, 30)
+        if mode != 10:
+            self.nextschedule = None  # the schedule is only followed in Normal mode, no change to wake up for
+        return (CONTROLCODES.get(self.Dev(1).sValue, 10), mode,
+                LEVELCODES[self.scheduledLevel(now)] if mode == 10 else 0,
+                float(self.Dev(4).sValue), float(self.Dev(5).sValue), self.PresenceTH, self.reducjour, self.reducnuit,
+                self.predictedTemp(), self.TRVtemp, self.Dev(7).nValue != 0, self.intemperror,
+                self.forced, self.endheat.timestamp(), self.forcedduration,
+                self.pause, self.pauserequested, self.pauserequestchangedtime.timestamp(), self.pauseondelay, self.pauseoffdelay,
+                self.switchHeat, self.setpoint, self.TRVsetpoint, self.TRVheld,
+                math.nan if self.TRVsetpointsent is None else self.TRVsetpointsent, self.TRVchangedtime.timestamp(),
+                self.heatchangedtime.timestamp(), math.nan if self.TRVsentsetpoint is None else self.TRVsentsetpoint)
+
+
+    def applyDecision(self, changes):
+
+        # changes of the decision kernel for this zone: new values, device updates and counters
+        for name, value in changes.items():
+            if name in ("forced", "pause", "switchHeat", "setpoint", "TRVsetpoint", "TRVheld"):
+                setattr(self, name, value)
+            elif name == "endheat":
+                self.endheat = datetime.fromtimestamp(value)
+            elif name == "heatchanged":
+                self.heatchangedtime = datetime.fromtimestamp(value)
+            elif name == "control":
+                self.updateDev(1, 1, str(value))  # set thermostat to normal mode
+            elif name == "heat":
+                self.updateDev(7, int(value), self.Dev(7).sValue)
+            elif name in ("heat_issued", "heat_suppressed"):
+                self.plugin.actuation[name] += value
+        for level, message, attribute in DECISIONLOGS[changes["event"]]:
+            if attribute:
+                getattr(self.log, level)("actuation", message, getattr(self, attribute))
+            else:
+                getattr(self.log, level)("actuation", message)
+
+    # TRV update functions ---------------------------------------------------
+    def updateHeaters(self):
+
+        # mise à jour des TRV uniquement si nécessaire
+        # one bulk read of all TRV setpoints, then write only to the TRV that are not at the setpoint
+        heaterssetpoints = self.readHeaters()
+        for idx in self.Heaters:
+            current_sp = heaterssetpoints.get(idx)
+            if current_sp is None:
+                continue
+
+            # Comparaison avec tolérance pour éviter les micro-différences
+            if abs(current_sp - self.TRVsetpoint) > 0.05:
+                if self.plugin.writer.put(idx, self.TRVsetpoint):
+                    self.plugin.actuation["trv_issued"] += 1
+                    self.plugin.metrics.inc("svt3_trv_writes_total")
+                    self.log.info("actuation", "Update TRV idx {} from {} to {}", idx, current_sp, self.TRVsetpoint)
+            else:
+                self.log.verbose("actuation", "TRV idx {} already at setpoint {}, no update", idx, current_sp)
 
-                if val_str is None:
-                    Domoticz.Error("Heater idx {} has no usable setpoint field in API result".format(idx))
-                    continue
-                try:
-                    current_sp = float(val_str)
-                except ValueError:
-                    Domoticz.Error("Heater idx {} has invalid setpoint value: '{}'".format(idx, val_str))
-                    continue
+    # Deadline functions ---------------------------------------------------
+    def nextDeadline(self):
 
-                # Comparaison avec tolérance pour éviter les micro-différences
-                if abs(current_sp - self.TRVsetpoint) > 0.05:
-                    Domoticz.Log("Update TRV idx {} from {} to {}".format(idx, current_sp, self.TRVsetpoint))
-                    DomoticzAPI("type=command&param=setsetpoint&idx={}&setpoint={}".format(idx, self.TRVsetpoint))
+        # earliest time at which the zone has something to do if no event or command comes:
+        # the next readings, the running timers and the next change of the schedule. A timer already over
+        # has been handled by the last heartbeat (or waits for the next actuation), it does not wake it up again.
+        now = datetime.now()
+        if self.tempsdirty or self.presencedirty:
+            return now
+        deadlines = []
+        if self.forced:
+            deadlines.append(self.endheat)
+        if self.pauserequested != self.pause:
+            delay = self.pauseondelay if self.pauserequested else self.pauseoffdelay
+            deadlines.append(self.pauserequestchangedtime + timedelta(minutes=delay))
+        if self.Presence != self.PresenceTH:
+            delay = self.presenceondelay if self.Presence else self.presenceoffdelay
+            deadlines.append(self.presencechangedtime + timedelta(minutes=delay))
+        if self.PresenceDetected:
+            deadlines.append(self.presencetimeline.until(now))
+        if self.nextschedule:
+            deadlines.append(self.nextschedule)
+        if self.plugin.hysteresis["heat_hold"]:
+            deadlines.append(self.heatchangedtime + timedelta(minutes=self.plugin.hysteresis["heat_hold"]))
+        readings = self.nexttemps + timedelta(minutes=self.plugin.tempsrefresh)
+        return min([deadline for deadline in deadlines if deadline > now] + [readings])
+
+
+    # Schedule functions ---------------------------------------------------
+    def scheduledLevel(self, now):
+
+        # comfort, night or eco level of the schedule. A warmer next level starts early by the time
+        # the room needs to reach its setpoint, and once started it is kept until the change.
+        if self.schedule is None:
+            return "comfort"
+        level, self.nextschedule, nextlevel = self.schedule.lookup(now)
+        if nextlevel is None:
+            return level
+        if self.preheating != self.nextschedule:
+            target = self.levelSetpoint(nextlevel)
+            if target <= self.levelSetpoint(level):
+                return level
+            lead = self.preheatLead(target)
+            if not lead or now + timedelta(minutes=lead) < self.nextschedule:
+                return level
+            self.preheating = self.nextschedule
+            self.log.verbose("actuation", "Pre-heating {} min before the {} level", lead, nextlevel)
+        return nextlevel
+
+
+    def levelSetpoint(self, level):
+
+        if level == "night":
+            return float(self.Dev(4).sValue) - self.reducnuit / 10
+        if level == "eco":
+            return float(self.Dev(5).sValue)
+        return float(self.Dev(4).sValue)
+
+
+    # Learning functions ---------------------------------------------------
+    def learnRates(self, now):
+
+        # one sample of the inside temperature rate since the previous one, with the heat given by the
+        # radiators during that time. Samples are at least 2 minutes apart, a longer gap starts again.
+        # The TRV sensors are warmer than the room while their radiator heats: that difference is the
+        # radiators heat, without TRV sensors it follows the heating request over predictive.lag minutes.
+        if self.TRVTempSensors:
+            heat = max(0.0, self.TRVtemp - self.intemp)
+        else:
+            heat = 1.0 if self.Dev(7).nValue != 0 else 0.0
+        if self.learnsample is not None:
+            time0, temp0, heat0 = self.learnsample
+            elapsed = (now - time0).total_seconds()
+            if elapsed < 120:
+                return
+            if elapsed <= 1800:
+                radiator0 = self.radiator
+                if self.TRVTempSensors:
+                    self.radiator = heat
                 else:
-                    Domoticz.Log("TRV idx {} already at setpoint {}, no update".format(idx, current_sp))
+                    self.radiator += (heat0 - self.radiator) * (1 - math.exp(-elapsed / 60 / self.plugin.predictive["lag"]))
+                self.model.update(temp0, (radiator0 + self.radiator) / 2, (self.intemp - temp0) * 3600 / elapsed)
+        self.learnsample = (now, self.intemp, heat)
+
+
+    def predictedTemp(self):
+
+        # highest inside temperature reached in predictive.lag minutes if the heating stops now, with the
+        # heat still in the radiators: the heating request stops before the room overshoots. It does not
+        # depend on the request itself, so switching it does not change the prediction and the request
+        # does not flap. The cooling of the room is not anticipated: the heating acts too late for that.
+        predictive = self.plugin.predictive
+        if not predictive["enabled"] or not self.model.ready(predictive["min_samples"]):
+            return self.intemp
+        drift = self.model.coast(self.intemp, self.radiator, predictive["lag"] / 60)
+        return self.intemp + max(0.0, min(1.0, drift))  # a badly learnt model cannot move it more than 1 degree
+
+
+    def preheatLead(self, target, maxminutes=180):
+
+        # minutes of heating needed to bring the room from its temperature to target, with the lag of the
+        # radiators warming up, 0 if unknown
+        predictive = self.plugin.predictive
+        if not predictive["enabled"] or not self.model.ready(predictive["min_samples"]) or self.intemp >= target:
+            return 0
+        return min(maxminutes, self.model.lead(self.intemp, target, maxminutes) + round(predictive["lag"]))
+
+
+    # Read TRV setpoints functions ---------------------------------------------------
+    def readHeaters(self):
+
+        # returns a dict idx: current setpoint of the TRV. The setpoint devices come from the shared
+        # snapshot, only the TRV not found there (other device types) are read one by one.
+        self.log.debug("actuation", "readHeaters called")
+        heatersdevices = self.plugin.snapshot.get("utility", self.Heaters)
+        missing = [idx for idx in self.Heaters if idx not in heatersdevices]
+        if missing:
+            heatersdevices.update(self.plugin.snapshot.get(None, missing))
+            for idx in missing:
+                if idx not in heatersdevices:
+                    self.log.error("actuation", "Heater idx {} not found in Domoticz (API)", idx)
+
+        heaterssetpoints = {}
+        for idx, dev in heatersdevices.items():
+            # Selon le type, la consigne peut être dans SetPoint, Data ou sValue
+            val_str = dev.get("SetPoint") or dev.get("Data") or dev.get("sValue")
+
+            if val_str is None:
+                self.log.error("actuation", "Heater idx {} has no usable setpoint field in API result", idx)
+                continue
+            try:
+                heaterssetpoints[idx] = float(val_str)
+            except ValueError:
+                self.log.error("actuation", "Heater idx {} has invalid setpoint value: '{}'", idx, val_str)
+        return heaterssetpoints
 
     def PresenceDetection(self):
 
             now = datetime.now()
     
-            if Parameters["Mode4"] == "":
-                Domoticz.Debug("presence detection mode = NO...")
+            if not self.DTpresence:
+                self.log.debug("presence", "presence detection mode = NO...")
                 self.Presencemode = False
                 self.Presence = False
                 self.PresenceTH = True
-                if not Devices[8].nValue == 0:
-                    Devices[8].Update(nValue = 0,sValue = Devices[8].sValue)
+                if not self.Dev(8).nValue == 0:
+                    self.updateDev(8, 0, self.Dev(8).sValue)
 
             else:
                 self.Presencemode = True
-                Domoticz.Debug("presence detection mode = YES...")
+                self.log.debug("presence", "presence detection mode = YES...")
 
 
-                # Build list of DT switches, with their current status
+                # Build list of DT switches, with their current status, and add them to the timeline of the DT
                 PresenceDT = {}
-                devicesAPI = DomoticzAPI("type=command&param=getdevices&filter=light&used=true&order=Name")
-                if devicesAPI:
-                    for device in devicesAPI["result"]:  # parse the presence/motion sensors (DT) device
-                        idx = int(device["idx"])
-                        if idx in self.DTpresence:  # this is one of our DT
-                            if "Status" in device:
-                                PresenceDT[idx] = True if device["Status"] == "On" else False
-                                Domoticz.Debug("DT switch {} currently is '{}'".format(idx,device["Status"]))
-                                if device["Status"] == "On":
-                                    self.DTtempo = datetime.now()
+                for idx, device in self.plugin.snapshot.get("light", self.DTpresence).items():  # parse the presence/motion sensors (DT) device
+                    if "Status" in device:
+                        PresenceDT[idx] = True if device["Status"] == "On" else False
+                        self.log.debug("presence", "DT switch {} currently is '{}'", idx,device["Status"])
+                        self.presencetimeline.observe(idx, PresenceDT[idx], device.get("LastUpdate"), now)
 
-                            else:
-                                Domoticz.Error("Device with idx={} does not seem to be a DT !".format(idx))
+                    else:
+                        self.log.error("presence", "Device with idx={} does not seem to be a DT !", idx)
 
 
                 # fool proof checking....
                 if len(PresenceDT) == 0:
-                   Domoticz.Error("none of the devices in the 'dt' parameter is a dt... no action !")
+                   self.log.error("presence", "none of the devices in the 'dt' parameter is a dt... no action !")
                    self.Presencemode = False
                    self.Presence = False
                    self.PresenceTH = True
-                   Devices[8].Update(nValue = 0,sValue = Devices[8].sValue)
+                   self.updateDev(8, 0, self.Dev(8).sValue)
                    return
 
-                if self.DTtempo + timedelta(seconds = 30) >= now:
+                if self.presencetimeline.occupied(now):
                     self.PresenceDetected = True
-                    Domoticz.Debug("At mini 1 DT is ON or was ON in the past 30 seconds...")
+                    self.log.debug("presence", "Enough DT are ON or were ON in the past {} seconds...",
+                                   self.plugin.presence["window"])
                 else:
                     self.PresenceDetected = False
 
 
                 if self.PresenceDetected:
-                    if Devices[8].nValue == 1:
-                        Domoticz.Debug("presence detected but already registred...")
+                    if self.Dev(8).nValue == 1:
+                        self.log.debug("presence", "presence detected but already registred...")
                     else:
-                        Domoticz.Debug("new presence detected...")
-                        Devices[8].Update(nValue = 1,sValue = Devices[8].sValue)
+                        self.log.debug("presence", "new presence detected...")
+                        self.updateDev(8, 1, self.Dev(8).sValue)
                         self.Presence = True
                         self.presencechangedtime = datetime.now()
 
                 else:
-                    if Devices[8].nValue == 0:
-                        Domoticz.Debug("No presence detected DT already OFF...")
+                    if self.Dev(8).nValue == 0:
+                        self.log.debug("presence", "No presence detected DT already OFF...")
                     else:
-                        Domoticz.Debug("No presence detected in the past 30 seconds...")
-                        Devices[8].Update(nValue = 0,sValue = Devices[8].sValue)
+                        self.log.debug("presence", "No presence detected in the past {} seconds...", self.plugin.presence["window"])
+                        self.updateDev(8, 0, self.Dev(8).sValue)
                         self.Presence = False
                         self.presencechangedtime = datetime.now()
 
@@ -479,177 +804,767 @@ class BasePlugin:
                 if self.Presence:
                     if not self.PresenceTH:
                         if self.presencechangedtime + timedelta(minutes = self.presenceondelay) <= now:
-                            Domoticz.Debug("Presence is now ACTIVE !")
+                            self.log.debug("presence", "Presence is now ACTIVE !")
                             self.PresenceTH = True
 
                         else:
-                                Domoticz.Debug("Presence is INACTIVE but in timer ON period !")
+                                self.log.debug("presence", "Presence is INACTIVE but in timer ON period !")
                     elif self.PresenceTH:
-                            Domoticz.Debug("Presence is ACTIVE !")
+                            self.log.debug("presence", "Presence is ACTIVE !")
                 else:
                     if self.PresenceTH:
                         if self.presencechangedtime + timedelta(minutes = self.presenceoffdelay) <= now:
-                            Domoticz.Debug("Presence is now INACTIVE because no DT since more than X minutes !")
+                            self.log.debug("presence", "Presence is now INACTIVE because no DT since more than X minutes !")
                             self.PresenceTH = False
 
                         else:
-                            Domoticz.Debug("Presence is ACTIVE but in timer OFF period !")
+                            self.log.debug("presence", "Presence is ACTIVE but in timer OFF period !")
                     else:
-                        Domoticz.Debug("Presence is INACTIVE !")
+                        self.log.debug("presence", "Presence is INACTIVE !")
 
     # Read Temperature  functions ---------------------------------------------------
-    def readTemps(self):
-        Domoticz.Debug("readTemps called")
-        self.nexttemps = datetime.now()
-        # fetch all the devices from the API and scan for sensors
+    def smoothTemp(self, name, value):
+
+        # exponential moving average of the fused temperatures, returns the rounded smoothed value
+        alpha = self.plugin.fusion["ewma"]
+        previous = self.smoothedtemps.get(name)
+        smoothed = value if previous is None else alpha * value + (1 - alpha) * previous
+        self.smoothedtemps[name] = smoothed
+        return round(smoothed, 1)
+
+    def readTemps(self, ttl=None):
+        self.log.debug("temps", "readTemps called")
+        now = datetime.now()
+        self.nexttemps = now
+        self.tempsdirty = False
+        # get our sensors from the shared device snapshot and validate them in a single pass
         noerror = True
         listintemps = []
         listtrvtemps = []
-        devicesAPI = DomoticzAPI("type=command&param=getdevices&filter=temp&used=true&order=Name")
-        if devicesAPI:
-            for device in devicesAPI["result"]:
-                idx = int(device["idx"])
-                # Room Temp
-                if idx in self.InTempSensors:
-                    # Ignorer temporairement s'il est dans la liste d'exclusion
-                    if idx in self.TempExcludedUntil:
-                        if datetime.now() < self.TempExcludedUntil[idx]:
-                            Domoticz.Debug(
-                                f"Capteur température idx {idx} temporairement exclu jusqu’à {self.TempExcludedUntil[idx]}")
-                            continue
-                        else:
-                            del self.TempExcludedUntil[idx]  # Réintégrer après délai
-                    # Vérifier le status du capteur
-                    skip = False
-                    if device.get("HardwareName") != "Dummies":
-                        if device.get("HaveTimeout", False):
-                            skip = True
-                        else:
-                            last_update_str = device.get("LastUpdate")
-                            if last_update_str:
-                                try:
-                                    last_update = datetime.strptime(last_update_str, "%Y-%m-%d %H:%M:%S")
-                                    if datetime.now() - last_update > timedelta(minutes=30):
-                                        skip = True
-                                except Exception as e:
-                                    Domoticz.Error(f"Erreur de parsing LastUpdate pour capteur {device['Name']}: {e}")
-                                    skip = True
-                    if skip:
-                        self.TempExcludedUntil[idx] = datetime.now() + timedelta(minutes=15)
-                        Domoticz.Debug(
-                            f"Exclusion température idx {idx} jusqu’à {self.TempExcludedUntil[idx]} pour timeout ou LastUpdate trop vieux")
-                        Domoticz.Error("Device with idx '{}' named '{}' is TimedOut !".format(idx, device["Name"]))
-                        continue
-                    # Capteur valide
-                    if "Temp" in device:
-                        Domoticz.Debug("device: {}-{} = {}".format(device["idx"], device["Name"], device["Temp"]))
-                        listintemps.append(device["Temp"])
-                    else:
-                        Domoticz.Error(
-                            "device: {}-{} is not a Temperature sensor".format(device["idx"], device["Name"]))
-                # TRV Temp
-                elif idx in self.TRVTempSensors:
-                    # Ignorer temporairement s'il est dans la liste d'exclusion
-                    if idx in self.TempExcludedUntil:
-                        if datetime.now() < self.TempExcludedUntil[idx]:
-                            Domoticz.Debug(
-                                f"Capteur température idx {idx} temporairement exclu jusqu’à {self.TempExcludedUntil[idx]}")
-                            continue
-                        else:
-                            del self.TempExcludedUntil[idx]  # Réintégrer après délai
-                    # Vérifier le status du capteur
-                    skip = False
-                    if device.get("HardwareName") != "Dummies":
-                        if device.get("HaveTimeout", False):
-                            skip = True
-                        else:
-                            last_update_str = device.get("LastUpdate")
-                            if last_update_str:
-                                try:
-                                    last_update = datetime.strptime(last_update_str, "%Y-%m-%d %H:%M:%S")
-                                    if datetime.now() - last_update > timedelta(minutes=30):
-                                        skip = True
-                                except Exception as e:
-                                    Domoticz.Error(f"Erreur de parsing LastUpdate pour capteur {device['Name']}: {e}")
-                                    skip = True
-                    if skip:
-                        self.TempExcludedUntil[idx] = datetime.now() + timedelta(minutes=15)
-                        Domoticz.Debug(
-                            f"Exclusion température idx {idx} jusqu’à {self.TempExcludedUntil[idx]} pour timeout ou LastUpdate trop vieux")
-                        Domoticz.Error("Device with idx '{}' named '{}' is TimedOut !".format(idx, device["Name"]))
-                        continue
-                    # Capteur valide
-                    if "Temp" in device:
-                        Domoticz.Debug("device: {}-{} = {}".format(device["idx"], device["Name"], device["Temp"]))
-                        listtrvtemps.append(device["Temp"])
-                    else:
-                        Domoticz.Error(
-                            "device: {}-{} is not a TRV Temp sensor".format(device["idx"], device["Name"]))
+        health = self.sensorhealth
+        health.expire(now)
+        for idx, device in self.plugin.snapshot.get("temp", self.TempSensors, ttl).items():
+            inside = idx in self.InTempSet  # Room Temp, else TRV Temp
+            if not health.check(idx, device, now):
+                continue
+            # Capteur valide
+            if "Temp" in device:
+                self.log.debug("temps", "device: {}-{} = {}", idx, device["Name"], device["Temp"])
+                (listintemps if inside else listtrvtemps).append((idx, device["Temp"]))
+            else:
+                self.log.error("temps", "device: {}-{} is not a {} sensor", idx, device["Name"],
+                               "Temperature" if inside else "TRV Temp")
+        for idx, name, state in health.drain():
+            if state == SensorHealth.TIMEDOUT:
+                self.log.error("temps", "Device with idx '{}' named '{}' is TimedOut !", idx, name)
+            elif state == SensorHealth.STALE:
+                self.log.error("temps", "Device with idx '{}' named '{}' not updated for {:.0f} minutes !", idx, name,
+                               health.stale.total_seconds() / 60)
+            elif state == SensorHealth.OK:
+                self.log.status("temps", "Device with idx '{}' named '{}' is working again", idx, name)
+            else:
+                self.log.debug("temps", "Device with idx '{}' named '{}' is recovering", idx, name)
 
-        # calculate averages
+        # calculate averages: weighted, without the outliers, then smoothed
+        fusion = self.plugin.fusion
         nb_in = len(listintemps)
         nb_trv = len(listtrvtemps)
 
         # --- 1) Inside temperature OK ---
         if nb_in > 0:
-            self.intemp = round(sum(listintemps) / nb_in, 1)
-            Devices[6].Update(nValue=0, sValue=str(self.intemp), TimedOut=False)
+            self.intemp = self.smoothTemp("in", FuseTemperatures(listintemps, fusion))
+            self.updateDev(6, 0, str(self.intemp), False)
 
             if self.intemperror:
                 # On sort du mode erreur si on en avait un
                 self.intemperror = False
-                self.WriteLog("Inside Temperature reading is now valid again: Resuming normal operation", "Status")
-                Devices[1].Update(nValue=Devices[1].nValue, sValue=Devices[1].sValue, TimedOut=False)
+                self.log.status("temps", "Inside Temperature reading is now valid again: Resuming normal operation")
+                self.updateDev(1, self.Dev(1).nValue, self.Dev(1).sValue, False)
 
             noerror = True
 
         # --- 2) Mode dégradé : pas de sonde intérieure, mais TRV OK ---
         elif nb_trv > 0:
             # On prend la moyenne des TRV comme température intérieure de secours
-            self.intemp = round(sum(listtrvtemps) / nb_trv, 1)
-            Devices[6].Update(nValue=0, sValue=str(self.intemp), TimedOut=False)
+            self.intemp = self.smoothTemp("in", FuseTemperatures(listtrvtemps, fusion))
+            self.updateDev(6, 0, str(self.intemp), False)
 
             if self.intemperror:
                 # Si on était en erreur avant, on repasse en mode "dégradé mais actif"
                 self.intemperror = False
-                Devices[1].Update(nValue=Devices[1].nValue, sValue=Devices[1].sValue, TimedOut=False)
+                self.updateDev(1, self.Dev(1).nValue, self.Dev(1).sValue, False)
 
-            Domoticz.Error("No valid Inside Temperature found: using TRV temperatures in degraded mode.")
+            self.log.error("temps", "No valid Inside Temperature found: using TRV temperatures in degraded mode.")
             noerror = True  # On autorise le chauffage à continuer sur cette base
 
         # --- 3) Erreur totale : ni Inside ni TRV ---
         else:
-            Domoticz.Error("No Inside Temperature and no TRV Temperature available... ")
+            self.log.error("temps", "No Inside Temperature and no TRV Temperature available... ")
             if not self.intemperror:
                 self.intemperror = True
-                Domoticz.Error("Switching heating request Off (no temperature reference).")
+                self.log.error("temps", "Switching heating request Off (no temperature reference).")
                 self.switchHeat = False
-                Devices[1].Update(nValue=Devices[1].nValue, sValue=Devices[1].sValue, TimedOut=True)
-                Devices[6].Update(nValue=Devices[6].nValue, sValue=Devices[6].sValue, TimedOut=True)
+                self.updateDev(1, self.Dev(1).nValue, self.Dev(1).sValue, True)
+                self.updateDev(6, self.Dev(6).nValue, self.Dev(6).sValue, True)
             return False  # pas de référence de température exploitable
 
         # --- TRV temperature calculation ---
         if nb_trv > 0:
-            self.TRVtemp = round(sum(listtrvtemps) / nb_trv, 1)
+            self.TRVtemp = self.smoothTemp("trv", FuseTemperatures(listtrvtemps, fusion))
         else:
             # Pas de TRV dispo : on se rabat sur intemp si elle existe,
             # sinon valeur neutre (mais le cas "plus rien du tout" est déjà géré plus haut)
-            Domoticz.Debug("No TRV Temperature found... Using Inside temperature as TRV temp")
+            self.log.debug("temps", "No TRV Temperature found... Using Inside temperature as TRV temp")
             self.TRVtemp = self.intemp
 
-        self.WriteLog("Inside Temperature = {}".format(self.intemp), "Verbose")
-        self.WriteLog("TRV Temperature = {}".format(self.TRVtemp), "Verbose")
+        self.log.verbose("temps", "Inside Temperature = {}", self.intemp)
+        self.log.verbose("temps", "TRV Temperature = {}", self.TRVtemp)
+        if self.learn and nb_in > 0:
+            self.learnRates(now)
         return noerror
 
 
-    # WriteLog functions ---------------------------------------------------
 
-    def WriteLog(self, message, level="Normal"):
 
-        if self.loglevel == "Verbose" and level == "Verbose":
-            Domoticz.Log(message)
-        elif level == "Normal":
-            Domoticz.Log(message)
+class BasePlugin:
+
+    def __init__(self):
+
+        now = datetime.now()  # Time helper
+
+        self.debug = False
+        self.loglevel = "Normal"
+        self.log = Log
+        self.metrics = Metrics()
+        self.devicecache = DeviceCache()
+        self.metricsinterval = 0  # seconds between two metrics dumps, 0 = no dump
+        self.metricsfile = ""
+        self.nextmetrics = now
+        self.breakerstate = "closed"  # last state of the API circuit seen by the plugin thread
+        self.nextwake = now  # heartbeats before this time are skipped, see onHeartbeat()
+        self.heartbeat = {"adaptive": True, "min": 10, "max": 30}
+        self.heartbeatinterval = HEARTBEAT
+        self.debounce = 3.0  # seconds before the TRV writes of a command are sent
+        self.Zones = []
+        self.RefreshAndActTime = now
+        self.NextInterval = random.randint(60, 90)
+        self.PLUGINstarteddtime = now
+        self.settings = {}
+        self.api = None
+        self.snapshot = None
+        self.writer = None
+        self.zigbee2mqtt = None  # optional direct zigbee2mqtt transport of the TRV
+        self.eventsmode = False
+        self.eventsconn = None
+        self.EventZones = {}  # idx: zones using this device
+        self.statefile = ""
+        self.statesaved = None  # last zones state written to the state file
+        self.periodicsaved = None  # last readings, actuations and learnt rates written to the state file
+        self.nextstatesave = now  # changes of the readings and actuations are written from this time on
+        self.fusion = {"weights": {}, "mad_threshold": 3.5, "ewma": 1.0}
+        self.hysteresis = {"trv": 0.2, "trv_hold": 0.0, "heat": 0.1, "heat_hold": 0.0}
+        self.predictive = {"enabled": True, "lag": 15.0, "min_samples": 30, "forgetting": 0.995}
+        self.health = {"stale": 30.0, "recover": 2}
+        self.presence = {"window": 30.0, "sensors": 1, "pulses": True}
+        self.startup = {"max_wait": 2.0, "fresh": 10.0, "jitter": 20.0}
+        self.started = False  # control started, see StartupReady()
+        self.startprobe = now  # time of the first readiness probe
+        self.actuation = {"trv_issued": 0, "trv_suppressed": 0, "heat_issued": 0, "heat_suppressed": 0}
+        self.tempsrefresh = 2  # time in minutes between two readings of the temperatures
+        return
+
+
+    def onStart(self):
+
+        # setup the appropriate logging level
+        try:
+            debuglevel = int(Parameters["Mode6"])
+        except ValueError:
+            debuglevel = 0
+            self.loglevel = Parameters["Mode6"]
+        if debuglevel != 0:
+            self.debug = True
+            Domoticz.Debugging(debuglevel)
+            DumpConfigToLog()
+            self.loglevel = "Verbose"
+        else:
+            self.debug = False
+            Domoticz.Debugging(0)
+
+        # load the optional advanced settings file
+        self.settings = LoadSettings()
+
+        # per subsystem (api, temps, presence, actuation) log levels, default is the Mode6 level
+        levels = {subsystem: level for subsystem, level in self.settings.get("log", {}).items() if subsystem != "repeat"}
+        self.log.setup("Debug" if self.debug else self.loglevel, levels, self.debug,
+                       repeat=self.GetSetting("log", "repeat", 900.0))
+
+        # keep-alive client used for every call to the domoticz json API
+        self.api = DomoticzClient(Parameters["Address"], Parameters["Port"],
+                                  Parameters["Username"], Parameters["Password"],
+                                  connecttimeout=self.GetSetting("api", "connect_timeout", 3.0),
+                                  readtimeout=self.GetSetting("api", "read_timeout", 10.0),
+                                  poolsize=self.GetSetting("api", "pool_size", 2), metrics=self.metrics,
+                                  breaker=CircuitBreaker(threshold=self.GetSetting("breaker", "threshold", 3),
+                                                         delay=self.GetSetting("breaker", "delay", 10.0),
+                                                         maxdelay=self.GetSetting("breaker", "max_delay", 300.0),
+                                                         jitter=self.GetSetting("breaker", "jitter", 0.2),
+                                                         slow=self.GetSetting("breaker", "slow", 5.0)))
+        self.snapshot = DeviceSnapshot(self.api, ttl=self.GetSetting("snapshot", "ttl", 10.0),
+                                       ridthreshold=self.GetSetting("snapshot", "rid_threshold", 3),
+                                       maxstale=self.GetSetting("snapshot", "max_stale", 300.0))
+        # optional direct transport of the TRV through zigbee2mqtt, the Domoticz API stays the default
+        transport = self.api
+        if self.GetSetting("zigbee2mqtt", "enabled", False):
+            client = MqttClient(self.GetSetting("zigbee2mqtt", "address", "127.0.0.1"),
+                                self.GetSetting("zigbee2mqtt", "port", 1883),
+                                "SVT3-{}-z2m".format(Parameters["HardwareID"]),
+                                username=self.GetSetting("zigbee2mqtt", "username", ""),
+                                password=self.GetSetting("zigbee2mqtt", "password", ""),
+                                keepalive=self.GetSetting("zigbee2mqtt", "keepalive", 60))
+            names = {int(idx): str(name) for idx, name in self.settings.get("zigbee2mqtt", {}).get("devices", {}).items()}
+            transport = self.zigbee2mqtt = Zigbee2Mqtt(self.api, client, self.GetSetting("zigbee2mqtt", "base_topic", "zigbee2mqtt"),
+                                                       names, self.settings.get("zigbee2mqtt", {}).get("fields"), metrics=self.metrics)
+        self.writer = WriteQueue(transport, interval=self.GetSetting("writes", "interval", 2.0),
+                                 retries=self.GetSetting("writes", "retries", 5),
+                                 backoff=self.GetSetting("writes", "backoff", 10.0))
+        self.debounce = self.GetSetting("writes", "debounce", 3.0)
+        # own devices: unchanged values are rewritten every "refresh" minutes only
+        self.devicecache.refresh = 60 * self.GetSetting("devices", "refresh", 30)
+
+        # metrics dumped to a prometheus text file and optionally to a text device
+        if self.GetSetting("metrics", "enabled", False):
+            self.metricsinterval = max(10, self.GetSetting("metrics", "interval", 60))
+            self.metricsfile = os.path.join(self.GetSetting("metrics", "folder", Parameters["HomeFolder"]),
+                                            "metrics_{}.prom".format(Parameters["HardwareID"]))
+            if self.GetSetting("metrics", "device", False) and METRICSUNIT not in Devices:
+                Domoticz.Device(Name="Thermostat metrics", Unit=METRICSUNIT, TypeName="Text", Used=0).Create()
+        self.writer.start()
+
+        # temperature fusion: per sensor weights, outliers rejection and smoothing
+        self.fusion = {"weights": {int(idx): float(weight) for idx, weight in self.settings.get("fusion", {}).get("weights", {}).items()},
+                       "mad_threshold": self.GetSetting("fusion", "mad_threshold", 3.5),
+                       "ewma": min(1.0, max(0.01, self.GetSetting("fusion", "ewma", 1.0)))}
+
+        # hysteresis bands (degrees) and minimum hold times (minutes) of the TRV setpoint and heating request
+        for key, default in self.hysteresis.items():
+            self.hysteresis[key] = self.GetSetting("hysteresis", key, default)
+
+        # learnt heating and cooling rates: anticipation lag (minutes) and samples needed before using them
+        for key, default in self.predictive.items():
+            self.predictive[key] = self.GetSetting("predictive", key, default)
+
+        # temperature sensors: minutes without reading before a sensor is ignored, new readings before it is used again
+        for key, default in self.health.items():
+            self.health[key] = self.GetSetting("health", key, default)
+
+        # presence: seconds a DT counts after it was last On, DT needed together, Off updates counted as pulses
+        for key, default in self.presence.items():
+            self.presence[key] = self.GetSetting("presence", key, default)
+
+        # build the zones: the first one comes from the hardware parameters, the other ones from settings.json
+        self.Zones = [Zone(self, 0, "Main", Parameters["Mode1"], Parameters["Mode2"], Parameters["Mode3"],
+                           Parameters["Mode4"], Parameters["Mode5"])]
+        zones = self.settings.get("zones", [])
+        if len(zones) > 24:
+            Domoticz.Error("Only 24 zones can be added to the main one (device units), zones ignored: {}".format(
+                ", ".join(str(zonesettings.get("name", "Zone {}".format(index))) for index, zonesettings in
+                          enumerate(zones[24:], 25))))
+        for zonesettings in zones[:24]:
+            index = len(self.Zones)
+            self.Zones.append(Zone(self, index, zonesettings.get("name", "Zone {}".format(index)),
+                                   str(zonesettings.get("inside", "")), str(zonesettings.get("trv", "")),
+                                   str(zonesettings.get("heaters", "")), str(zonesettings.get("presence", "")),
+                                   str(zonesettings.get("params", Parameters["Mode5"]))))
+        for zone in self.Zones:
+            zone.CreateDevices()
+            if self.GetSetting("history", "enabled", False):
+                zone.history = HistoryBuffer(self.GetSetting("history", "size", 1440), os.path.join(
+                    self.GetSetting("history", "folder", Parameters["HomeFolder"]),
+                    "history_{}_{}".format(Parameters["HardwareID"], zone.index)))
+            schedule = self.ZoneSchedule(zone)
+            if schedule:
+                try:
+                    zone.schedule = Schedule(schedule.get("week", {}), schedule.get("holidays", []),
+                                             schedule.get("holiday", "sun"))
+                except (ValueError, TypeError, AttributeError) as e:
+                    Domoticz.Error("Invalid schedule of zone '{}', not used: {}".format(zone.name, e))
+            self.snapshot.watch("temp", itertools.chain(zone.InTempSensors, zone.TRVTempSensors))
+            self.snapshot.watch("light", zone.DTpresence)
+            self.snapshot.watch("utility", zone.Heaters)
+            for idx in itertools.chain(zone.InTempSensors, zone.TRVTempSensors, zone.DTpresence, zone.Heaters):
+                self.EventZones.setdefault(idx, []).append(zone)
+            if self.zigbee2mqtt:
+                self.zigbee2mqtt.watch("inside", zone.InTempSensors)
+                self.zigbee2mqtt.watch("trv", zone.TRVTempSensors)
+                self.zigbee2mqtt.watch("setpoint", zone.Heaters)
+        if self.zigbee2mqtt:
+            self.zigbee2mqtt.start()
+            self.log.status("actuation", "zigbee2mqtt transport for {} device(s) on {}:{}", len(self.zigbee2mqtt.devices),
+                            self.zigbee2mqtt.client.host, self.zigbee2mqtt.client.port)
+
+        # start-up: control starts once the devices report fresh values (at most max_wait minutes), the first
+        # probe is delayed by a jitter of its own to each hardware so that several instances do not start together.
+        # The first actuation is spread the same way.
+        for key, default in self.startup.items():
+            self.startup[key] = self.GetSetting("startup", key, default)
+        self.PLUGINstarteddtime = datetime.now()
+        spread = random.Random(Parameters["HardwareID"])
+        jitter = spread.uniform(0, self.startup["jitter"])
+        self.startprobe = self.PLUGINstarteddtime + timedelta(seconds=jitter)
+        self.NextInterval = spread.randint(60, 90)
+
+        # restore the state saved before the last stop, so control resumes without the start-up wait
+        self.statefile = os.path.join(Parameters["HomeFolder"], "state_{}.json".format(Parameters["HardwareID"]))
+        self.started = self.LoadState()
+
+        # event driven mode: device changes are received from the domoticz MQTT gateway feed (domoticz/out)
+        # and the periodic reading of the devices becomes a reconciliation safety net
+        self.eventsmode = self.GetSetting("events", "enabled", False)
+        if self.eventsmode:
+            self.tempsrefresh = self.GetSetting("events", "reconcile", 15)
+            self.snapshot.ttl = self.tempsrefresh * 60
+            self.eventsconn = Domoticz.Connection(Name="SVT3 events", Transport="TCP/IP", Protocol="MQTT",
+                                                  Address=self.GetSetting("events", "address", "127.0.0.1"),
+                                                  Port=str(self.GetSetting("events", "port", 1883)))
+            self.eventsconn.Connect()
+
+        # Set domoticz heartbeat to 20 s, then adapted to the next deadline by ScheduleHeartbeat()
+        # adaptive heartbeat: seconds between two heartbeats (domoticz accepts up to 30)
+        for key, default in self.heartbeat.items():
+            self.heartbeat[key] = self.GetSetting("heartbeat", key, default)
+        self.heartbeat["min"] = max(1, min(self.heartbeat["min"], 30))
+        self.heartbeat["max"] = max(self.heartbeat["min"], min(self.heartbeat["max"], 30))
+        # before the start, the first heartbeat comes at the start probe: the instances started together keep
+        # heartbeats of different phases. The first probe sets the heartbeat back to 20 s.
+        if not self.started:
+            self.heartbeatinterval = max(1, math.ceil(jitter))
+        Domoticz.Heartbeat(self.heartbeatinterval)
+
+
+    def onStop(self):
+
+        if self.eventsconn and self.eventsconn.Connected():
+            self.eventsconn.Send({"Verb": "DISCONNECT"})
+            self.eventsconn.Disconnect()
+        if self.writer:
+            lost = self.writer.stop()
+            if lost:
+                Domoticz.Error("{} TRV setpoint(s) not sent before stopping".format(lost))
+        if self.zigbee2mqtt:
+            self.zigbee2mqtt.stop()
+            Domoticz.Log("zigbee2mqtt: {} setpoints published, {} states received, {} setpoints not reported by their TRV".format(
+                self.zigbee2mqtt.published, self.zigbee2mqtt.received, self.zigbee2mqtt.pending()))
+        self.SaveState(final=True)
+        if self.metricsinterval:
+            self.DumpMetrics()
+        for zone in self.Zones:
+            if zone.history:
+                zone.history.flush()
+        Domoticz.Log("TRV writes: {trv_issued} issued, {trv_suppressed} suppressed - heating request changes: "
+                     "{heat_issued} issued, {heat_suppressed} suppressed".format(**self.actuation))
+        Domoticz.Log("Device updates: {} written, {} suppressed".format(self.devicecache.written, self.devicecache.suppressed))
+        if self.api:
+            self.api.LogStats()
+            self.api.close()
+        Domoticz.Debugging(0)
+
+
+    def ZoneOfUnit(self, Unit):
+
+        index = Unit // 10
+        return self.Zones[index] if index < len(self.Zones) else None
+
+
+    def onCommand(self, Unit, Command, Level, Color):
+
+        Domoticz.Debug("onCommand called for Unit {}: Command '{}', Level: {}".format(Unit, Command, Level))
+
+        zone = self.ZoneOfUnit(Unit)
+        if zone is None:
+            return
+        zone.onCommand(Unit % 10, Command, Level)
+        now = datetime.now()
+        self.nextwake = now
+
+        # control, mode and setpoints: only this zone is updated, the full heartbeat comes later
+        if Unit % 10 in (1, 2, 4, 5) and self.started:
+            with self.metrics.timer("svt3_command_seconds"):
+                zone.onCommandUpdate(now)
+            self.SaveState()
+
+
+    def onConnect(self, Connection, Status, Description):
+
+        if Connection is not self.eventsconn:
+            return
+        if Status == 0:
+            Domoticz.Debug("Connected to MQTT broker, subscribing to device events")
+            Connection.Send({"Verb": "CONNECT", "ID": "SVT3-{}".format(Parameters["HardwareID"])})
+        else:
+            Domoticz.Error("Failed to connect to MQTT broker for device events: {}".format(Description))
+
+
+    def onMessage(self, Connection, Data):
+
+        if Connection is not self.eventsconn:
+            return
+        verb = Data.get("Verb")
+        if verb == "CONNACK":
+            Connection.Send({"Verb": "SUBSCRIBE", "PacketIdentifier": 1001,
+                             "Topics": [{"Topic": self.GetSetting("events", "topic", "domoticz/out"), "QoS": 0}]})
+        elif verb == "PUBLISH":
+            try:
+                payload = json.loads(Data["Payload"].decode("utf-8"))
+            except (KeyError, ValueError, AttributeError):
+                return
+            self.onDeviceEvent(payload)
+
+
+    def onDisconnect(self, Connection):
+
+        if Connection is self.eventsconn:
+            Domoticz.Error("Disconnected from MQTT broker, device events are lost until reconnection")
+            for zone in self.Zones:
+                zone.tempsdirty = True
+
+
+    def onDeviceModified(self, Unit):
+
+        self.devicecache.invalidate(Unit)
+        zone = self.ZoneOfUnit(Unit)
+        if zone and Unit in Devices:
+            zone.onDeviceModified(Unit % 10)
+            self.nextwake = datetime.now()
+
+
+    def onDeviceEvent(self, payload):
+
+        # incremental update of the device snapshot from a domoticz/out message
+        try:
+            idx = int(payload.get("idx", 0))
+        except (TypeError, ValueError):
+            return
+        zones = self.EventZones.get(idx)
+        if not zones:
+            return
+        lastupdate = payload.get("LastUpdate") or datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        if idx in zones[0].DTpresence:
+            status = "On" if payload.get("nvalue", 0) > 0 else "Off"
+            self.log.debug("presence", "Event: DT {} is now '{}'", idx, status)
+            self.snapshot.update(idx, {"Status": status, "LastUpdate": lastupdate})
+            for zone in zones:
+                zone.presencetimeline.observe(idx, status == "On", lastupdate, datetime.now())
+                zone.presencedirty = True
+        elif idx in zones[0].Heaters:
+            self.snapshot.update(idx, {"SetPoint": payload.get("svalue1"), "LastUpdate": lastupdate})
+        else:
+            try:
+                temp = float(payload.get("svalue1"))
+            except (TypeError, ValueError):
+                return
+            self.log.debug("temps", "Event: temperature sensor {} = {}", idx, temp)
+            if self.snapshot.update(idx, {"Temp": temp, "LastUpdate": lastupdate, "HaveTimeout": False}):
+                for zone in zones:
+                    zone.tempsdirty = True
+
+
+    def onTransportState(self, idx, fields):
+
+        # device fields received from the zigbee2mqtt transport, applied like the domoticz/out events
+        zones = self.EventZones.get(idx)
+        if not zones:
+            return
+        if "Temp" in fields or "SetPoint" in fields:
+            fields["LastUpdate"] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        self.log.debug("temps", "zigbee2mqtt: device {} = {}", idx, fields)
+        if self.snapshot.push(idx, fields) and "SetPoint" not in fields:
+            for zone in zones:
+                zone.tempsdirty = True
+
+
+    def onHeartbeat(self):
+
+        now = datetime.now()
+        # fool proof checking.... based on users feedback
+        if not all(zone.DevicesOK() for zone in self.Zones):
+            self.log.error("actuation", "one or more devices required by the plugin is/are missing, please check domoticz device creation settings and restart !")
+            return
+
+        if not self.started and not self.StartupReady(now):
+            self.log.info("actuation", "---> Plugin starting.... Wait a while")  # we wait for Zigbee plugin starting well and all others needed...
+            return
+
+        # Plugin really started.....
+        if self.eventsmode:
+            if self.eventsconn.Connected():
+                self.eventsconn.Send({"Verb": "PING"})
+            elif not self.eventsconn.Connecting():
+                self.eventsconn.Connect()
+        if self.zigbee2mqtt:
+            for idx, fields in self.zigbee2mqtt.drain():
+                self.onTransportState(idx, fields)
+            if self.snapshot.pushed and not self.zigbee2mqtt.client.connected():
+                self.log.status("api", "zigbee2mqtt broker not connected, the TRV are read from the Domoticz API again")
+                self.snapshot.unpush()
+
+        # nothing can change before the next deadline: skip this heartbeat, unless a device event came
+        # or background writes have to be reported
+        if self.heartbeat["adaptive"] and now < self.nextwake and not self.writer.depth() and not self.writer.done() \
+                and not any(zone.tempsdirty or zone.presencedirty for zone in self.Zones):
+            self.metrics.inc("svt3_heartbeats_skipped_total")
+            return
+        start = time.perf_counter()
+
+        actuate = False
+        if self.RefreshAndActTime + timedelta(seconds=self.NextInterval) <= now:
+            # reset timer
+            self.RefreshAndActTime = now
+            # on redéfinit un nouvel intervalle pour le prochain tour
+            self.NextInterval = random.randint(60, 90)
+            self.log.debug("actuation", "Action déclenchée (prochain déclenchement dans {}s)", self.NextInterval)
+            actuate = True
+
+        # report the TRV writes done in background since the last heartbeat
+        for idx, setpoint, error in self.writer.drain():
+            if error is None:
+                self.log.debug("actuation", "TRV idx {} set to {}", idx, setpoint)
+                self.snapshot.update(idx, {"SetPoint": str(setpoint)})
+            else:
+                self.log.error("actuation", "TRV idx {} could not be set to {}: {}", idx, setpoint, error)
+
+        # the circuit state changes in the writer thread too, it is reported from here
+        breakerstate = self.api.breaker.state
+        if breakerstate != self.breakerstate:
+            if breakerstate == CircuitBreaker.OPEN:
+                self.log.status("api", "Domoticz API not responding, calls suspended for {:.0f}s "
+                                "(last values kept for {:.0f}s)", self.api.breaker.opendelay, self.snapshot.maxstale)
+            elif breakerstate == CircuitBreaker.CLOSED:
+                self.log.status("api", "Domoticz API responding again")
+            self.breakerstate = breakerstate
+
+        # all the zones share the same device snapshot during this heartbeat, and their modes are
+        # decided in one pass
+        for zone in self.Zones:
+            zone.onHeartbeat(now)
+        self.UpdateModes(self.Zones, now)
+        for zone in self.Zones:
+            zone.onActuate(now, actuate)
+
+        if self.writer.depth():
+            self.log.debug("actuation", "{} TRV setpoint(s) waiting to be sent", self.writer.depth())
+
+        self.SaveState()
+        self.metrics.observe("svt3_heartbeat_seconds", time.perf_counter() - start)
+        if self.metricsinterval and self.nextmetrics <= now:
+            self.nextmetrics = now + timedelta(seconds=self.metricsinterval)
+            self.DumpMetrics()
+
+        if self.heartbeat["adaptive"]:
+            self.ScheduleHeartbeat(now)
+
+    def StartupReady(self, now):
+
+        # control starts when the temperature sensors of the zones have been updated in the last "fresh" minutes
+        # and their TRV are found without timeout, or after max_wait minutes. One shared read per probe.
+        if now < self.startprobe:
+            return False
+        self.SetHeartbeat(HEARTBEAT)
+        waited = (now - self.PLUGINstarteddtime).total_seconds()
+        fresh = now - timedelta(minutes=self.startup["fresh"])
+        sensors = {idx for zone in self.Zones for idx in zone.TempSensors}
+        heaters = {idx for zone in self.Zones for idx in zone.Heaters}
+        devices = self.snapshot.get("temp", sensors)
+        devices.update(self.snapshot.get("utility", heaters))
+        missing = [idx for idx in heaters if idx not in devices]
+        if missing:
+            devices.update(self.snapshot.get(None, missing))
+        waiting = []
+        for idx in sorted(sensors | heaters):
+            device = devices.get(idx)
+            if device is None or device.get("HaveTimeout", False):
+                waiting.append(idx)
+            elif idx in sensors and device.get("HardwareName") != "Dummies":
+                try:
+                    if datetime.strptime(device.get("LastUpdate", ""), "%Y-%m-%d %H:%M:%S") < fresh:
+                        waiting.append(idx)
+                except ValueError:
+                    waiting.append(idx)
+        if waiting and waited < 60 * self.startup["max_wait"]:
+            self.log.debug("actuation", "Waiting for devices {} before starting", waiting)
+            return False
+        if waiting:
+            self.log.status("actuation", "Starting after {:.0f}s, devices {} not ready", waited, waiting)
+        else:
+            self.log.status("actuation", "Devices ready, starting after {:.0f}s", waited)
+        self.metrics.set("svt3_startup_seconds", round(waited))
+        self.started = True
+        return True
+
+
+    def UpdateModes(self, zones, now):
+
+        # setpoint, TRV setpoint and heating request of the zones, from their last readings
+        columns = DecisionColumns([zone.decisionInputs(now) for zone in zones])
+        changes = [{} for zone in zones]
+        for index, name, value in Decide(columns, now.timestamp(), self.hysteresis):
+            changes[index][name] = value
+        for zone, zonechanges in zip(zones, changes):
+            zone.applyDecision(zonechanges)
+
+
+    def ScheduleHeartbeat(self, now):
+
+        # next heartbeat that has something to do, and a heartbeat interval that wakes up close to it
+        deadlines = [zone.nextDeadline() for zone in self.Zones]
+        deadlines.append(self.RefreshAndActTime + timedelta(seconds=self.NextInterval))
+        if self.metricsinterval:
+            deadlines.append(self.nextmetrics)
+        self.nextwake = min(deadlines)
+        wait = (self.nextwake - now).total_seconds()
+        self.SetHeartbeat(int(max(self.heartbeat["min"], min(self.heartbeat["max"], wait))))
+
+    def SetHeartbeat(self, interval):
+
+        if interval != self.heartbeatinterval:
+            self.heartbeatinterval = interval
+            Domoticz.Heartbeat(interval)
+
+    # Metrics functions ---------------------------------------------------
+    def DumpMetrics(self):
+
+        # gauges and counters kept by the other parts of the plugin are taken at dump time
+        metrics = self.metrics
+        metrics.set("svt3_write_queue_depth", self.writer.depth())
+        metrics.set("svt3_api_circuit_open", int(self.api.breaker.state != CircuitBreaker.CLOSED))
+        metrics.total("svt3_api_circuit_openings_total", self.api.breaker.opened)
+        metrics.total("svt3_writes_sent_total", self.writer.sent)
+        metrics.total("svt3_writes_failed_total", self.writer.failed)
+        metrics.total("svt3_writes_coalesced_total", self.writer.coalesced)
+        metrics.total("svt3_device_updates_total", self.devicecache.written, result="written")
+        metrics.total("svt3_device_updates_total", self.devicecache.suppressed, result="suppressed")
+        if self.zigbee2mqtt:
+            metrics.set("svt3_mqtt_connected", int(self.zigbee2mqtt.client.connected()))
+            metrics.total("svt3_mqtt_connects_total", self.zigbee2mqtt.client.connects)
+            metrics.set("svt3_trv_ack_pending", self.zigbee2mqtt.pending())
+        for kind, value in self.actuation.items():
+            metrics.total("svt3_actuation_total", value, kind=kind)
+        for zone in self.Zones:
+            counts = zone.sensorhealth.counts()
+            metrics.set("svt3_excluded_sensors", sum(counts.values()) - counts[SensorHealth.OK], zone=zone.name)
+            for state, count in counts.items():
+                metrics.set("svt3_sensor_health", count, zone=zone.name, state=state)
+            for idx, sensor in zone.sensorhealth.sensors.items():
+                if sensor.interval is not None:
+                    metrics.set("svt3_sensor_update_interval_seconds", round(sensor.interval), idx=idx)
+            metrics.set("svt3_inside_temperature", zone.intemp, zone=zone.name)
+            metrics.set("svt3_trv_setpoint", zone.TRVsetpoint, zone=zone.name)
+            if zone.model.ready(self.predictive["min_samples"]):
+                metrics.set("svt3_cooling_rate", round(zone.model.rate(zone.intemp, 0.0), 3), zone=zone.name)
+                metrics.set("svt3_predicted_temperature", round(zone.predictedTemp(), 2), zone=zone.name)
+
+        tmpfile = self.metricsfile + ".tmp"
+        try:
+            with open(tmpfile, "w", encoding="utf-8") as f:
+                f.write(metrics.prometheus())
+            os.replace(tmpfile, self.metricsfile)
+        except OSError as e:
+            self.log.error("api", "Error writing metrics file {}: {}", self.metricsfile, e)
+        if METRICSUNIT in Devices:
+            self.devicecache.update(METRICSUNIT, 0, metrics.summary())
+
+    # State file functions ---------------------------------------------------
+
+    def LoadState(self):
+
+        # returns True if a recent enough state has been restored
+        try:
+            with open(self.statefile, encoding="utf-8") as f:
+                state = json.load(f)
+            # the learnt rates are still valid after a long stop
+            for zone in self.Zones:
+                if str(zone.index) in state.get("models", {}):
+                    zone.model.SetState(state["models"][str(zone.index)])
+            age = datetime.now() - datetime.fromisoformat(state["saved"])
+            if age > timedelta(minutes=self.GetSetting("state", "max_age", 30)):
+                Domoticz.Log("Saved state is too old ({}), not restored".format(age))
+                return False
+            for zone in self.Zones:
+                if str(zone.index) in state["zones"]:
+                    zone.SetState(dict(state.get("periodic", {}).get(str(zone.index), {}), **state["zones"][str(zone.index)]))
+        except FileNotFoundError:
+            return False
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            Domoticz.Error("Error reading state file '{}': {}".format(self.statefile, e))
+            return False
+        self.statesaved, self.periodicsaved = self.DumpState()
+        Domoticz.Log("State restored from {}".format(self.statefile))
+        return True
+
+
+    def SaveState(self, final=False):
+
+        # the state file is only written when the forced mode, pause, presence or health change, or every
+        # state.interval minutes (and when stopping) when only the readings, actuations and learnt rates changed.
+        # It is written through a temporary file renamed over the old one so it is never left half written
+        if not self.statefile:
+            return
+        now = datetime.now()
+        state, periodic = self.DumpState()
+        if state == self.statesaved and (periodic == self.periodicsaved or (now < self.nextstatesave and not final)):
+            return
+        tmpfile = self.statefile + ".tmp"
+        try:
+            with open(tmpfile, "w", encoding="utf-8") as f:
+                f.write('{{"saved": "{}", {}, {}}}'.format(now.isoformat(), state, periodic))
+            os.replace(tmpfile, self.statefile)
+            self.statesaved, self.periodicsaved = state, periodic
+            self.nextstatesave = now + timedelta(minutes=self.GetSetting("state", "interval", 10))
+        except OSError as e:
+            Domoticz.Error("Error writing state file '{}': {}".format(self.statefile, e))
+
+
+    def DumpState(self):
+
+        # "zones" member of the state file, and "periodic" and "models" members written less often
+        zones = json.dumps({str(zone.index): zone.GetState() for zone in self.Zones}, sort_keys=True)
+        periodic = json.dumps({str(zone.index): zone.GetState(Zone.PERIODICKEYS) for zone in self.Zones}, sort_keys=True)
+        models = json.dumps({str(zone.index): zone.model.GetState() for zone in self.Zones}, sort_keys=True)
+        return '"zones": {}'.format(zones), '"periodic": {}, "models": {}'.format(periodic, models)
+
+
+    # Schedule functions ---------------------------------------------------
+
+    def ZoneSchedule(self, zone):
+
+        # schedule settings of a zone: the "schedule" section, with the members given in the
+        # "schedule" of the zone replacing it. A zone can have "schedule": false.
+        schedule = dict(self.settings.get("schedule", {}))
+        if zone.index > 0:
+            override = self.settings["zones"][zone.index - 1].get("schedule")
+            if override is False:
+                return None
+            schedule.update(override or {})
+        if not schedule.get("enabled", True) or not schedule.get("week"):
+            return None
+        return schedule
+
+
+    # Settings functions ---------------------------------------------------
+
+    def GetSetting(self, section, key, default):
+
+        # returns settings[section][key] converted to the type of the default value
+        value = self.settings.get(section, {}).get(key, default)
+        if isinstance(default, bool):
+            return str(value).lower() in ("true", "1", "yes", "on")
+        try:
+            return type(default)(value)
+        except (TypeError, ValueError):
+            Domoticz.Error(f"Setting '{section}.{key}' has an invalid value of '{value}' ! defaut of '{default}' is instead used.")
+            return default
+
+
 
 
 # Plugin functions ---------------------------------------------------
@@ -673,6 +1588,26 @@ def onCommand(Unit, Command, Level, Color):
     _plugin.onCommand(Unit, Command, Level, Color)
 
 
+def onConnect(Connection, Status, Description):
+    global _plugin
+    _plugin.onConnect(Connection, Status, Description)
+
+
+def onMessage(Connection, Data):
+    global _plugin
+    _plugin.onMessage(Connection, Data)
+
+
+def onDisconnect(Connection):
+    global _plugin
+    _plugin.onDisconnect(Connection)
+
+
+def onDeviceModified(Unit):
+    global _plugin
+    _plugin.onDeviceModified(Unit)
+
+
 def onHeartbeat():
     global _plugin
     _plugin.onHeartbeat()
@@ -700,38 +1635,1331 @@ def parseCSV(strCSV):
 
 
 
-def DomoticzAPI(APICall):
-    resultJson = None
-    url = f"http://127.0.0.1:8080/json.htm?{parse.quote(APICall, safe='&=')}"
+CIRCUITOPEN = "Domoticz API circuit open, call skipped"
+
+
+class DomoticzClient:
+
+    # Keep-alive client for the domoticz json API. Idle connections are kept in a small pool
+    # so that consecutive calls reuse the same TCP socket instead of doing a new handshake.
+
+    def __init__(self, host, port, username="", password="", connecttimeout=3.0, readtimeout=10.0, poolsize=2, metrics=None,
+                 breaker=None):
+        self.host = host or "127.0.0.1"
+        self.port = int(port or 8080)
+        self.connecttimeout = connecttimeout
+        self.readtimeout = readtimeout
+        self.poolsize = max(1, poolsize)
+        self.headers = {"Connection": "keep-alive"}
+        if username != "":
+            credentials = "{}:{}".format(username, password)
+            encoded_credentials = base64.b64encode(credentials.encode("utf-8"))
+            self.headers["Authorization"] = "Basic {}".format(encoded_credentials.decode("ascii"))
+        self.pool = []  # idle keep-alive connections
+        self.busy = set()  # connections of the requests in flight, for abort()
+        self.lock = threading.Lock()
+        self.stats = {}  # per API call: [calls, errors, total time, max time]
+        self.metrics = metrics  # optional Metrics fed with the latency of each call
+        self.breaker = breaker  # optional CircuitBreaker
+
+    def call(self, APICall):
+        Log.debug("api", "Domoticz API request: {}", APICall)
+        resultJson, error = self.request(APICall)
+        if error is CIRCUITOPEN:
+            Log.debug("api", "Domoticz API circuit open, skipped: {}", APICall)
+        elif error:
+            Log.error("api", error)
+        return resultJson
+
+    def request(self, APICall):
+        # returns (json result, error message). Does not log, so it can be used out of the plugin thread.
+        resultJson = None
+        error = None
+        path = "/json.htm?{}".format(parse.quote(APICall, safe="&="))
+        param = parse.parse_qs(APICall).get("param", ["?"])[0]
+        if self.breaker and not self.breaker.allow():
+            if self.metrics:
+                self.metrics.inc("svt3_api_refused_total", param=param)
+            return None, CIRCUITOPEN
+        failed = False  # the server did not answer properly, for the circuit breaker
+        start = time.monotonic()
+        conn = self._acquire()
+        try:
+            response, body = self._request(conn, path)
+            if response.status == 200:
+                resultJson = json.loads(body.decode("utf-8"))
+                if resultJson.get("status") != "OK":
+                    error = f"Domoticz API returned an error: status = {resultJson.get('status')}"
+                    resultJson = None
+            else:
+                error = f"Domoticz API: HTTP error = {response.status}"
+                failed = True
+            if response.will_close:
+                conn.close()
+            self._release(conn)
+
+        except json.JSONDecodeError as e:
+            error = f"JSON decoding error: {e}"
+            failed = True
+            self._release(conn)
+
+        except Exception as e:
+            error = f"Error calling '{path}': {e}"
+            failed = True
+            self._discard(conn)
+
+        elapsed = time.monotonic() - start
+        self._record(param, elapsed, resultJson is None)
+        if self.breaker:
+            if failed or elapsed > self.breaker.slow:
+                self.breaker.failure()
+            else:
+                self.breaker.success()
+        return resultJson, error
 
+    def _request(self, conn, path):
+        # a reused socket may have been closed by the server in the meantime: retry once on a fresh one
+        reused = conn.sock is not None
+        while True:
+            try:
+                if conn.sock is None:
+                    conn.connect()
+                    conn.sock.settimeout(self.readtimeout)
+                conn.request("GET", path, headers=self.headers)
+                response = conn.getresponse()
+                return response, response.read()
+            except (http.client.RemoteDisconnected, http.client.CannotSendRequest, ConnectionError):
+                conn.close()
+                if not reused:
+                    raise
+                reused = False
+
+    def _acquire(self):
+        with self.lock:
+            conn = self.pool.pop() if self.pool else \
+                http.client.HTTPConnection(self.host, self.port, timeout=self.connecttimeout)
+            self.busy.add(conn)
+        return conn
+
+    def _release(self, conn):
+        with self.lock:
+            self.busy.discard(conn)
+            if len(self.pool) < self.poolsize:
+                self.pool.append(conn)
+                return
+        conn.close()
+
+    def _discard(self, conn):
+        with self.lock:
+            self.busy.discard(conn)
+        conn.close()
+
+    def _record(self, param, elapsed, error):
+        with self.lock:
+            stat = self.stats.setdefault(param, [0, 0, 0.0, 0.0])
+            stat[0] += 1
+            stat[1] += 1 if error else 0
+            stat[2] += elapsed
+            stat[3] = max(stat[3], elapsed)
+        if self.metrics:
+            self.metrics.observe("svt3_api_call_seconds", elapsed, param=param)
+            if error:
+                self.metrics.inc("svt3_api_errors_total", param=param)
+
+    def setsetpoint(self, idx, setpoint):
+        # TRV setpoint write, the transport interface used by the WriteQueue (see Zigbee2Mqtt)
+        return self.request("type=command&param=setsetpoint&idx={}&setpoint={}".format(idx, setpoint))
+
+    def LogStats(self):
+        with self.lock:
+            for param, (calls, errors, total, worst) in sorted(self.stats.items()):
+                Domoticz.Log("API {}: {} calls, {} errors, avg {:.0f} ms, max {:.0f} ms".format(
+                    param, calls, errors, 1000 * total / calls, 1000 * worst))
+
+    def abort(self):
+        # makes the requests in flight fail at once rather than wait for their read timeout, at stop.
+        # A request still connecting waits for its connect timeout.
+        with self.lock:
+            socks = [conn.sock for conn in self.busy if conn.sock is not None]
+        for sock in socks:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def close(self):
+        with self.lock:
+            while self.pool:
+                self.pool.pop().close()
+
+
+
+class CircuitBreaker:
+
+    # Circuit breaker of the domoticz API. After threshold failures in a row (no answer, HTTP error or an
+    # answer slower than slow seconds) the circuit opens and the calls are refused without reaching the
+    # server. When the open delay is over, one call goes through (half-open): the circuit closes if it
+    # succeeds, else it opens again for twice the delay (up to maxdelay). The delay has some jitter so that
+    # several instances do not come back at the same time. Used from the plugin and the writer threads.
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALFOPEN = "half-open"
+
+    def __init__(self, threshold=3, delay=10.0, maxdelay=300.0, jitter=0.2, slow=5.0):
+        self.threshold = max(1, threshold)
+        self.delay = delay
+        self.maxdelay = maxdelay
+        self.jitter = jitter
+        self.slow = slow
+        self.state = self.CLOSED
+        self.failures = 0  # failures in a row
+        self.backoffs = 0  # openings in a row, for the exponential delay
+        self.retryat = 0.0  # monotonic time of the next half-open call
+        self.opendelay = 0.0  # last open delay
+        self.opened = 0
+        self.refused = 0
+        self.lock = threading.Lock()
+
+    def allow(self):
+        with self.lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN and time.monotonic() >= self.retryat:
+                self.state = self.HALFOPEN  # this call is the probe, the others wait for its result
+                return True
+            self.refused += 1
+            return False
+
+    def success(self):
+        with self.lock:
+            self.state = self.CLOSED
+            self.failures = 0
+            self.backoffs = 0
+
+    def failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.state == self.HALFOPEN or self.failures >= self.threshold:
+                delay = min(self.maxdelay, self.delay * 2 ** self.backoffs)
+                self.opendelay = delay * random.uniform(1 - self.jitter, 1 + self.jitter)
+                self.retryat = time.monotonic() + self.opendelay
+                self.backoffs += 1
+                self.opened += 1
+                self.state = self.OPEN
+
+    def retryin(self):
+        # seconds before the next call can go through. While half-open the probe of another thread decides,
+        # check again shortly (its result can take the connect and read timeouts)
+        with self.lock:
+            if self.state == self.HALFOPEN:
+                return min(self.delay, 1.0)
+            return max(0.0, self.retryat - time.monotonic()) if self.state != self.CLOSED else 0.0
+
+
+class WriteQueue:
+
+    # Background writer of the TRV setpoints, so the heartbeat does not wait for the API.
+    # Pending setpoints are kept per idx: a newer value replaces the one not sent yet. Writes are
+    # spaced by interval seconds to not flood the zigbee mesh, failed ones are retried with an
+    # exponential backoff. Results are handed back to the plugin thread through drain().
+    # The writes go through api.setsetpoint(), the DomoticzClient or the Zigbee2Mqtt transport.
+
+    def __init__(self, api, interval=2.0, retries=5, backoff=10.0):
+        self.api = api
+        self.interval = interval
+        self.retries = retries
+        self.backoff = backoff
+        self.pending = {}  # idx: [setpoint, attempts, not before (monotonic time)]
+        self.results = []  # (idx, setpoint, error) of the finished writes, error is None when ok
+        self.inflight = None  # idx being written
+        self.cond = threading.Condition()
+        self.running = False
+        self.thread = None
+        self.sent = 0
+        self.failed = 0
+        self.coalesced = 0
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(name="SVT3 writes", target=self._run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        with self.cond:
+            self.running = False
+            self.cond.notify()
+        if self.thread:
+            # a write in flight could wait for the read timeout of the API, longer than the join
+            self.api.abort()
+            self.thread.join(timeout=5)
+        return len(self.pending)
+
+    def put(self, idx, setpoint, delay=0.0):
+        # queue a setpoint for a TRV, returns False if the same value is already waiting
+        with self.cond:
+            current = self.pending.get(idx)
+            if current is not None:
+                if current[0] == setpoint:
+                    return False
+                self.coalesced += 1
+            self.pending[idx] = [setpoint, 0, time.monotonic() + delay]
+            self.cond.notify()
+        return True
+
+    def depth(self):
+        with self.cond:
+            return len(self.pending) + (self.inflight is not None)
+
+    def done(self):
+        # number of finished writes waiting for drain()
+        with self.cond:
+            return len(self.results)
+
+    def drain(self):
+        with self.cond:
+            results, self.results = self.results, []
+        return results
+
+    def _run(self):
+        nextwrite = 0.0
+        while True:
+            with self.cond:
+                while self.running:
+                    now = time.monotonic()
+                    due = min(self.pending.items(), key=lambda item: item[1][2], default=None)
+                    if due and max(due[1][2], nextwrite) <= now:
+                        break
+                    self.cond.wait(timeout=(max(due[1][2], nextwrite) - now) if due else None)
+                if not self.running:
+                    return
+                idx, (setpoint, attempts, notbefore) = due
+                del self.pending[idx]
+                self.inflight = idx
+
+            resultJson, error = self.api.setsetpoint(idx, setpoint)
+
+            with self.cond:
+                self.inflight = None
+                if error is None:
+                    self.sent += 1
+                    self.results.append((idx, setpoint, None))
+                elif error is CIRCUITOPEN:
+                    # not sent at all: wait for the circuit to let calls through again
+                    if idx not in self.pending:
+                        self.pending[idx] = [setpoint, attempts, time.monotonic() + self.api.breaker.retryin()]
+                    continue
+                elif idx not in self.pending:  # else superseded by a newer setpoint while in flight: dropped
+                    attempts += 1
+                    if attempts < self.retries:
+                        self.pending[idx] = [setpoint, attempts, time.monotonic() + self.backoff * 2 ** (attempts - 1)]
+                    else:
+                        self.failed += 1
+                        self.results.append((idx, setpoint, error))
+            # space the writes
+            nextwrite = time.monotonic() + self.interval
+
+
+class MqttClient:
+
+    # Minimal MQTT 3.1.1 client (QoS 0 only) keeping one persistent connection to a broker. It runs in its
+    # own thread: it reconnects with a growing delay, pings the broker when the connection is idle and passes
+    # the received messages to onmessage(topic, payload) in that thread. publish() can be used from any thread.
+    # Domoticz.Connection cannot be used here, it is only served in the plugin thread.
+
+    def __init__(self, host, port, clientid, username="", password="", keepalive=60, onmessage=None):
+        self.host = host
+        self.port = int(port)
+        self.clientid = clientid
+        self.username = username
+        self.password = password
+        self.keepalive = keepalive
+        self.onmessage = onmessage
+        self.topics = []
+        self.sock = None
+        self.buffer = bytearray()  # bytes received and not parsed yet, kept across the read timeouts
+        self.lastsent = 0.0  # monotonic time of the last packet sent, for the keep-alive pings
+        self.lock = threading.Lock()  # one writer of the socket at a time
+        self.stopping = threading.Event()
+        self.thread = None
+        self.connects = 0
+        self.error = "not connected yet"  # last connection error
+
+    def start(self, topics):
+        self.topics = list(topics)
+        self.thread = threading.Thread(name="SVT3 mqtt", target=self._run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopping.set()
+        with self.lock:
+            if self.sock:
+                try:
+                    self.sock.sendall(b"\xe0\x00")  # DISCONNECT
+                except OSError:
+                    pass
+        self._close()
+        if self.thread:
+            self.thread.join(timeout=5)
+
+    def connected(self):
+        return self.sock is not None and self.thread is not None and self.thread.is_alive()
+
+    def publish(self, topic, payload):
+        # returns None when sent, else the error message
+        with self.lock:
+            if self.sock is None:
+                return "MQTT broker not connected: {}".format(self.error)
+            try:
+                self.sock.sendall(self._packet(0x30, self._string(topic) + payload))
+                self.lastsent = time.monotonic()
+            except OSError as e:
+                return "MQTT publish failed: {}".format(e)
+        return None
+
+    def _run(self):
+        delay = 1.0
+        while not self.stopping.is_set():
+            try:
+                sock = self._connect()
+                delay = 1.0
+                self._loop(sock)
+            except Exception as e:  # also a failing onmessage: connect again rather than lose the thread
+                self.error = str(e) or type(e).__name__
+            self._close()
+            self.stopping.wait(delay)
+            delay = min(60.0, delay * 2)
+
+    def _connect(self):
+        sock = socket.create_connection((self.host, self.port), timeout=3)  # below the join of stop()
+        self.buffer = bytearray()
+        try:
+            flags = 0x02  # clean session
+            payload = self._string(self.clientid)
+            if self.username:
+                flags |= 0x80
+                payload += self._string(self.username)
+                if self.password:
+                    flags |= 0x40
+                    payload += self._string(self.password)
+            sock.sendall(self._packet(0x10, self._string("MQTT") + bytes((4, flags)) +
+                                      struct.pack("!H", self.keepalive) + payload))
+            kind, body = self._read(sock)
+            if kind != 0x20 or len(body) < 2 or body[1] != 0:
+                raise ValueError("MQTT connection refused by the broker (code {})".format(body[1] if len(body) > 1 else "?"))
+            if self.topics:
+                sock.sendall(self._packet(0x82, struct.pack("!H", 1) +
+                                          b"".join(self._string(topic) + b"\x00" for topic in self.topics)))
+        except (OSError, ValueError):
+            sock.close()
+            raise
+        sock.settimeout(self.keepalive / 4)
+        with self.lock:
+            self.sock = sock
+            self.lastsent = time.monotonic()
+        self.connects += 1
+        self.error = None
+        return sock
+
+    def _loop(self, sock):
+        pingsent = None  # time of the ping waiting for its answer
+        while not self.stopping.is_set():
+            try:
+                kind, body = self._read(sock)
+            except socket.timeout:
+                kind, body = None, b""
+            now = time.monotonic()
+            if kind == 0xd0:
+                pingsent = None
+            elif kind is None and pingsent is not None and now - pingsent > self.keepalive / 2:
+                raise OSError("MQTT broker not answering")
+            # the broker drops a client that sends nothing for 1.5 keepalive, however much it receives
+            if pingsent is None and now - self.lastsent >= self.keepalive / 2:
+                with self.lock:
+                    sock.sendall(b"\xc0\x00")  # PINGREQ
+                    self.lastsent = now
+                pingsent = now
+            if kind is not None and kind & 0xf0 == 0x30 and self.onmessage:
+                message = self.parsePublish(kind, body)
+                if message:
+                    self.onmessage(*message)
+
+    def _read(self, sock):
+        # next packet (type, body); a timeout keeps the bytes already received for the next call
+        while True:
+            packet = self.parsePacket(self.buffer)
+            if packet:
+                return packet
+            chunk = sock.recv(4096)
+            if not chunk:
+                raise OSError("connection closed by the MQTT broker")
+            self.buffer += chunk
+
+    @staticmethod
+    def parsePacket(buffer):
+        # removes the first complete packet from the buffer and returns (type, body), None if incomplete
+        length = 0
+        position = 1
+        while True:
+            if position >= len(buffer):
+                return None
+            byte = buffer[position]
+            length |= (byte & 0x7f) << (7 * (position - 1))
+            position += 1
+            if not byte & 0x80:
+                break
+            if position > 4:
+                raise ValueError("malformed MQTT packet length")
+        if len(buffer) < position + length:
+            return None
+        packet = (buffer[0], bytes(buffer[position:position + length]))
+        del buffer[:position + length]
+        return packet
+
+    @staticmethod
+    def parsePublish(kind, body):
+        # (topic, payload) of a PUBLISH packet, None if it is malformed
+        if len(body) < 2:
+            return None
+        length = struct.unpack("!H", body[:2])[0]
+        start = 2 + length + (2 if kind & 0x06 else 0)  # packet identifier when QoS > 0
+        if len(body) < start:
+            return None
+        return body[2:2 + length].decode("utf-8", "replace"), body[start:]
+
+    def _close(self):
+        with self.lock:
+            sock, self.sock = self.sock, None
+        if sock:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)  # also wakes up a read blocked in the client thread
+            except OSError:
+                pass
+            sock.close()
+
+    @staticmethod
+    def _string(text):
+        data = text.encode("utf-8")
+        return struct.pack("!H", len(data)) + data
+
+    @staticmethod
+    def _packet(kind, body):
+        length = len(body)
+        header = bytearray((kind,))
+        while True:
+            byte = length & 0x7f
+            length >>= 7
+            header.append(byte | 0x80 if length else byte)
+            if not length:
+                return bytes(header) + body
+
+
+class Zigbee2Mqtt:
+
+    # Direct zigbee2mqtt transport of the TRV, with the setsetpoint() and breaker of the DomoticzClient it
+    # replaces in the WriteQueue. The setpoints of the devices given a zigbee2mqtt name are published to
+    # <base>/<name>/set, the other ones (and all of them while the broker is not connected) still go through
+    # the Domoticz API. The states published by zigbee2mqtt on <base>/<name> and <base>/<name>/availability
+    # become device fields for the shared snapshot, handed to the plugin thread by drain().
+
+    FIELDS = {"setpoint": "current_heating_setpoint", "trv": "local_temperature", "inside": "temperature"}
+
+    def __init__(self, api, client, base="zigbee2mqtt", names=None, fields=None, metrics=None):
+        self.api = api
+        self.breaker = api.breaker
+        self.client = client
+        self.base = base.rstrip("/")
+        self.names = names or {}  # idx: zigbee2mqtt friendly name
+        self.fields = dict(self.FIELDS, **(fields or {}))  # role: zigbee2mqtt state field
+        self.devices = {}  # friendly name: [(idx, role)]
+        self.metrics = metrics
+        self.lock = threading.Lock()
+        self.states = []  # (idx, device fields) received, see drain()
+        self.acks = {}  # idx: (setpoint, monotonic time of the publish) waiting for zigbee2mqtt to report it
+        self.published = 0
+        self.received = 0
+        client.onmessage = self.onmessage
+
+    def watch(self, role, idxlist):
+        # register the devices of the zones with their role (setpoint, trv or inside)
+        for idx in idxlist:
+            if idx in self.names:
+                self.devices.setdefault(self.names[idx], []).append((idx, role))
+
+    def topics(self):
+        return ["{}/{}{}".format(self.base, name, suffix) for name in sorted(self.devices) for suffix in ("", "/availability")]
+
+    def start(self):
+        self.client.start(self.topics())
+
+    def stop(self):
+        self.client.stop()
+
+    def abort(self):
+        self.api.abort()
+
+    def setsetpoint(self, idx, setpoint):
+        name = self.names.get(idx)
+        if name is None or not self.client.connected():
+            return self.api.setsetpoint(idx, setpoint)
+        payload = json.dumps({self.fields["setpoint"]: setpoint}).encode("utf-8")
+        error = self.client.publish("{}/{}/set".format(self.base, name), payload)
+        if error:
+            if self.metrics:
+                self.metrics.inc("svt3_mqtt_errors_total")
+            return None, error
+        with self.lock:
+            self.acks[idx] = (float(setpoint), time.monotonic())
+            self.published += 1
+        return {"status": "OK"}, None
+
+    def onmessage(self, topic, payload):
+        # called in the MQTT client thread
+        name = topic[len(self.base) + 1:]
+        availability = name.endswith("/availability")
+        if availability:
+            name = name[:-len("/availability")]
+        devices = self.devices.get(name)
+        if not devices:
+            return
+        if availability:
+            # {"state": "offline"} or the legacy plain "offline" payload
+            offline = b"offline" in payload
+            updates = [(idx, {"HaveTimeout": offline}) for idx, role in devices]
+        else:
+            try:
+                state = json.loads(payload.decode("utf-8"))
+            except ValueError:
+                return
+            if not isinstance(state, dict):
+                return
+            updates = []
+            for idx, role in devices:
+                try:
+                    value = float(state[self.fields[role]])
+                except (KeyError, TypeError, ValueError):
+                    continue
+                if role == "setpoint":
+                    updates.append((idx, {"SetPoint": str(value), "HaveTimeout": False}))
+                    self._acknowledge(idx, value)
+                else:
+                    updates.append((idx, {"Temp": value, "HaveTimeout": False}))
+        with self.lock:
+            self.states.extend(updates)
+            self.received += 1
+        if self.metrics:
+            self.metrics.inc("svt3_mqtt_messages_total")
+
+    def _acknowledge(self, idx, value):
+        # time between the publish of a setpoint and the TRV reporting it
+        with self.lock:
+            ack = self.acks.get(idx)
+            if ack is None or abs(ack[0] - value) > 0.01:
+                return
+            del self.acks[idx]
+        if self.metrics:
+            self.metrics.observe("svt3_trv_ack_seconds", time.monotonic() - ack[1])
+
+    def pending(self):
+        # setpoints published and not reported by their TRV yet
+        with self.lock:
+            return len(self.acks)
+
+    def drain(self):
+        with self.lock:
+            states, self.states = self.states, []
+        return states
+
+
+class Schedule:
+
+    # Weekly timetable of the setpoint levels, compiled into a sorted table of the transitions of the
+    # next days so the heartbeat finds the active level and the next change by bisection. A timetable
+    # is a list of ["HH:MM", level] per day (mon ... sun, "default" for the days not given) and a day
+    # starts with the last level of the day before. Holidays follow the timetable of the "holiday" day.
+
+    LEVELS = ("comfort", "night", "eco")
+    DAYS = ("mon", "tue", "wed", "thu", "fri", "sat", "sun")
+    HORIZON = 8  # days compiled in advance
+
+    def __init__(self, week, holidays=(), holiday="sun"):
+        self.week = []
+        for day in self.DAYS:
+            self.week.append(self._timetable(week.get(day, week.get("default", []))))
+        self.holiday = self._timetable(holiday) if isinstance(holiday, list) else self.week[self.DAYS.index(holiday)]
+        self.holidays = set()
+        for period in holidays:
+            first, last = (period, period) if isinstance(period, str) else period
+            day = date.fromisoformat(first)
+            while day <= date.fromisoformat(last):
+                self.holidays.add(day)
+                day += timedelta(days=1)
+        if not any(self.week):
+            raise ValueError("empty timetable")
+        self.times = []  # sorted times of the transitions
+        self.levels = []  # level from each transition
+        self.until = None  # end of the compiled table
+
+    def _timetable(self, entries):
+        timetable = []
+        for start, level in entries:
+            if level not in self.LEVELS:
+                raise ValueError("unknown level '{}'".format(level))
+            hours, minutes = start.split(":")
+            timetable.append((timedelta(hours=int(hours), minutes=int(minutes)), level))
+        return sorted(timetable)
+
+    def _day(self, day):
+        return self.holiday if day in self.holidays else self.week[day.weekday()]
+
+    def compile(self, now):
+        # transitions from today to HORIZON days later, starting with the level in force at midnight
+        midnight = datetime.combine(now.date(), datetime.min.time())
+        level = "comfort"
+        for back in range(1, 8):
+            timetable = self._day(now.date() - timedelta(days=back))
+            if timetable:
+                level = timetable[-1][1]
+                break
+        self.times = [midnight]
+        self.levels = [level]
+        for offset in range(self.HORIZON):
+            day = midnight + timedelta(days=offset)
+            for at, newlevel in self._day(day.date()):
+                if newlevel == level:
+                    continue
+                if day + at == self.times[-1]:
+                    self.levels[-1] = newlevel
+                else:
+                    self.times.append(day + at)
+                    self.levels.append(newlevel)
+                level = newlevel
+        self.until = midnight + timedelta(days=self.HORIZON - 1)
+
+    def lookup(self, now):
+        # (active level, time of the next change, next level), the next change is None if not known
+        if self.until is None or now >= self.until or now < self.times[0]:
+            self.compile(now)
+        position = bisect.bisect_right(self.times, now) - 1
+        if position + 1 < len(self.times):
+            return self.levels[position], self.times[position + 1], self.levels[position + 1]
+        return self.levels[position], None, None
+
+
+class ThermalModel:
+
+    # Learnt inside temperature rate of a zone, in degrees per hour: rate = a + b * heat + c * (temp - 20),
+    # heat being the radiators heat from 0 (cold) to 1. Fitted by recursive least squares with a forgetting
+    # factor, so it follows the seasons: a few multiplications per sample and no history kept.
+
+    def __init__(self, forgetting=0.995):
+        self.forgetting = forgetting
+        self.theta = [0.0, 0.0, 0.0]
+        self.P = [[100.0, 0.0, 0.0], [0.0, 100.0, 0.0], [0.0, 0.0, 100.0]]  # covariance of theta
+        self.samples = [0, 0]  # samples learnt with the radiators mostly cold / hot
+        self.fullheat = 0.0  # radiators heat when heating at full power, slowly forgotten
+
+    def update(self, temp, heat, rate):
+        x = (1.0, heat, temp - 20)
+        P = self.P
+        Px = [P[i][0] * x[0] + P[i][1] * x[1] + P[i][2] * x[2] for i in range(3)]
+        gain = 1 / (self.forgetting + x[0] * Px[0] + x[1] * Px[1] + x[2] * Px[2])
+        error = rate - (self.theta[0] * x[0] + self.theta[1] * x[1] + self.theta[2] * x[2])
+        for i in range(3):
+            self.theta[i] += Px[i] * gain * error
+        # without new information the covariance would grow for ever, it is not forgotten above a limit
+        forgetting = self.forgetting if P[0][0] + P[1][1] + P[2][2] < 1000 else 1.0
+        self.P = [[(P[i][j] - Px[i] * Px[j] * gain) / forgetting for j in range(3)] for i in range(3)]
+        self.samples[1 if heat >= 0.5 else 0] += 1
+        self.fullheat = max(heat, self.fullheat * 0.9999)
+
+    def ready(self, minsamples):
+        return min(self.samples) >= minsamples
+
+    def rate(self, temp, heat):
+        return self.theta[0] + self.theta[1] * heat + self.theta[2] * (temp - 20)
+
+    def coast(self, temp, heat, hours):
+        # temperature change in hours without heating, the radiators cooling down over the same time
+        return self.rate(temp, 0.0) * hours + self.theta[1] * heat * hours * (1 - math.exp(-1))
+
+    def lead(self, fromtemp, totemp, maxminutes):
+        # minutes of heating at full power from fromtemp to totemp, rate = a + c * (temp - 20) integrated
+        a = self.theta[0] + self.theta[1] * self.fullheat
+        c = self.theta[2]
+        start = a + c * (fromtemp - 20)
+        end = a + c * (totemp - 20)
+        if start <= 0 or end <= 0:
+            return maxminutes  # the heating cannot reach it
+        hours = (totemp - fromtemp) / start if abs(c) < 1e-6 else math.log(end / start) / c
+        return min(maxminutes, max(0, round(hours * 60)))
+
+    def GetState(self):
+        return {"theta": self.theta, "P": self.P, "samples": self.samples, "fullheat": self.fullheat}
+
+    def SetState(self, state):
+        self.theta = [float(value) for value in state["theta"]]
+        self.P = [[float(value) for value in row] for row in state["P"]]
+        self.samples = [int(value) for value in state["samples"]]
+        self.fullheat = float(state.get("fullheat", 0.0))
+
+
+class SensorState:
+
+    # health and reading statistics of one sensor, see SensorHealth
+
+    def __init__(self, name):
+        self.name = name
+        self.state = None
+        self.lastupdate = None  # LastUpdate string of the last reading
+        self.updated = None  # same, parsed
+        self.timedout = False
+        self.dummy = False
+        self.recovered = 0  # new readings since the sensor is recovering
+        self.readings = 0  # new readings seen
+        self.interval = None  # smoothed seconds between two readings
+        self.queued = False  # in the staleness heap
+
+
+class SensorHealth:
+
+    # Health of the temperature sensors of a zone. A sensor is "ok", "stale" (no new reading for stale
+    # minutes), "timedout" (reported by Domoticz) or "recovering" (reading again after a failure, used
+    # again after recover new readings). A sensor is only evaluated again when its LastUpdate or timeout
+    # flag changes; the time at which each ok sensor gets stale is kept in a heap, checked by expire().
+
+    OK = "ok"
+    STALE = "stale"
+    TIMEDOUT = "timedout"
+    RECOVERING = "recovering"
+    STATES = (OK, STALE, TIMEDOUT, RECOVERING)
+
+    def __init__(self, stale=30.0, recover=2):
+        self.stale = timedelta(minutes=stale)
+        self.recover = recover
+        self.sensors = {}  # idx: SensorState
+        self.heap = []  # (time the sensor gets stale, idx), one entry per ok or recovering sensor
+        self.changes = []  # (idx, name, new state) not reported yet, see drain()
+        self.restored = {}  # idx: (state, LastUpdate, recovered) from the state file
+
+    def check(self, idx, device, now):
+        # state of a sensor from a device read, returns True if its reading can be used
+        sensor = self.sensors.get(idx)
+        if sensor is None:
+            sensor = self.sensors[idx] = SensorState(device.get("Name", ""))
+            sensor.dummy = device.get("HardwareName") == "Dummies"
+            sensor.state, sensor.lastupdate, sensor.recovered = self.restored.pop(idx, (None, None, 0))
+        lastupdate = device.get("LastUpdate")
+        timedout = bool(device.get("HaveTimeout", False)) and not sensor.dummy
+        if sensor.updated is None or lastupdate != sensor.lastupdate or timedout != sensor.timedout:
+            self._evaluate(idx, sensor, lastupdate, timedout, now)
+        return sensor.state == self.OK
+
+    def expire(self, now):
+        # sensors without a new reading for stale minutes
+        while self.heap and self.heap[0][0] <= now:
+            due, idx = heapq.heappop(self.heap)
+            sensor = self.sensors[idx]
+            sensor.queued = False
+            if sensor.state not in (self.OK, self.RECOVERING):
+                continue
+            if sensor.updated + self.stale > now:
+                self._queue(idx, sensor)  # read again since queued
+            else:
+                self._set(idx, sensor, self.STALE)
+
+    def drain(self):
+        changes, self.changes = self.changes, []
+        return changes
+
+    def counts(self):
+        counts = dict.fromkeys(self.STATES, 0)
+        for sensor in self.sensors.values():
+            if sensor.state:
+                counts[sensor.state] += 1
+        return counts
+
+    def _evaluate(self, idx, sensor, lastupdate, timedout, now):
+        newreading = False
+        if lastupdate != sensor.lastupdate or sensor.updated is None:
+            sensor.lastupdate = lastupdate
+            previous = sensor.updated
+            try:
+                sensor.updated = datetime.strptime(lastupdate, "%Y-%m-%d %H:%M:%S") if lastupdate else None
+            except ValueError:
+                sensor.updated = None
+            if previous and sensor.updated and sensor.updated > previous:
+                newreading = True
+                interval = (sensor.updated - previous).total_seconds()
+                sensor.interval = interval if sensor.interval is None else sensor.interval + 0.2 * (interval - sensor.interval)
+                sensor.readings += 1
+        sensor.timedout = timedout
+
+        if sensor.dummy:
+            state = self.OK
+        elif timedout:
+            state = self.TIMEDOUT
+        elif sensor.updated is None or now - sensor.updated > self.stale:
+            state = self.STALE
+        elif sensor.state in (None, self.OK):
+            state = self.OK
+        else:
+            sensor.recovered = (sensor.recovered if sensor.state == self.RECOVERING else 0) + newreading
+            state = self.OK if sensor.recovered >= self.recover else self.RECOVERING
+        self._set(idx, sensor, state)
+        if state in (self.OK, self.RECOVERING) and not sensor.dummy and not sensor.queued:
+            self._queue(idx, sensor)
+
+    def _set(self, idx, sensor, state):
+        if state != sensor.state:
+            if sensor.state is not None or state != self.OK:
+                self.changes.append((idx, sensor.name, state))
+            sensor.state = state
+
+    def _queue(self, idx, sensor):
+        sensor.queued = True
+        heapq.heappush(self.heap, (sensor.updated + self.stale, idx))
+
+    def GetState(self):
+        state = {str(idx): list(values) for idx, values in self.restored.items()}
+        state.update((str(idx), [sensor.state, sensor.lastupdate, sensor.recovered])
+                     for idx, sensor in self.sensors.items() if sensor.state not in (None, self.OK))
+        return state
+
+    def SetState(self, state):
+        # failing and recovering sensors stay so after a restart
+        self.restored = {int(idx): tuple(values) for idx, values in state.items()}
+
+
+class PresenceTimeline:
+
+    # Presence of a zone from the timeline of each of its motion sensors (DT): whether it is On, the last time
+    # it was seen On and its last LastUpdate. A DT read Off was On until its LastUpdate when it was On before.
+    # With pulses, a DT read Off with a LastUpdate newer than the last one seen was On in between and counts
+    # as a detection at the time of the reading: the short detections between two readings are not lost.
+    # The zone is occupied while "sensors" DT (at most all of them) are On or were On in the last "window"
+    # seconds, in one pass over the DT.
+
+    def __init__(self, window=30.0, sensors=1, pulses=True):
+        self.window = timedelta(seconds=window)
+        self.sensors = max(1, sensors)
+        self.pulses = pulses
+        self.timeline = {}  # idx: [On, last time On, last LastUpdate]
+
+    def observe(self, idx, on, lastupdate, now):
+        # a reading (snapshot or event) of a DT
+        try:
+            updated = datetime.strptime(lastupdate, "%Y-%m-%d %H:%M:%S") if lastupdate else None
+        except ValueError:
+            updated = None
+        entry = self.timeline.get(idx)
+        if entry is None:
+            entry = self.timeline[idx] = [False, None, None]
+        if on:
+            entry[1] = now
+        elif updated and entry[0]:
+            entry[1] = max(entry[1], updated) if entry[1] else updated
+        elif updated and self.pulses and entry[2] is not None and updated > entry[2]:
+            entry[1] = now  # a detection found at this reading, the window starts now
+        entry[0] = on
+        if updated and (entry[2] is None or updated > entry[2]):
+            entry[2] = updated
+
+    def occupied(self, now):
+        needed = min(self.sensors, len(self.timeline))
+        recent = sum(1 for on, laston, updated in self.timeline.values()
+                     if on or (laston is not None and laston + self.window >= now))
+        return needed > 0 and recent >= needed
+
+    def until(self, now):
+        # time at which the zone is no longer occupied if no new reading comes
+        times = [now if on else laston for on, laston, updated in self.timeline.values() if on or laston is not None]
+        needed = min(self.sensors, len(self.timeline))
+        if needed == 0 or len(times) < needed:
+            return now
+        return heapq.nlargest(needed, times)[-1] + self.window
+
+
+class HistoryBuffer:
+
+    # Fixed size ring buffer of the per cycle values of a zone, kept in typed arrays so that recording
+    # a cycle does not allocate. Every size records, the new ones are appended to a gzip compressed
+    # csv file per day (<fileprefix>_YYYYMMDD.csv.gz).
+
+    FIELDS = ("time", "intemp", "TRVtemp", "setpoint", "TRVsetpoint", "presence", "heating")
+
+    def __init__(self, size, fileprefix):
+        self.size = max(10, size)
+        self.fileprefix = fileprefix
+        self.columns = [array("d", bytes(8 * self.size)) for field in self.FIELDS]
+        self.next = 0  # position of the next record
+        self.stored = 0  # records in the buffer
+        self.unsaved = 0  # records not written to the files yet
+
+    def add(self, *values):
+        position = self.next
+        for column, value in zip(self.columns, values):
+            column[position] = value
+        self.next = (position + 1) % self.size
+        self.stored = min(self.stored + 1, self.size)
+        self.unsaved += 1
+        if self.unsaved >= self.size:
+            self.flush()
+
+    def rows(self, last=None):
+        # the last records in time order, as tuples
+        count = self.stored if last is None else min(last, self.stored)
+        for position in range(self.next - count, self.next):
+            yield tuple(column[position % self.size] for column in self.columns)
+
+    def flush(self):
+        # append the records not saved yet to the files of their day
+        rows = list(self.rows(self.unsaved))
+        self.unsaved = 0
+        byday = {}
+        for row in rows:
+            byday.setdefault(datetime.fromtimestamp(row[0]).strftime("%Y%m%d"), []).append(row)
+        for day, dayrows in byday.items():
+            filename = "{}_{}.csv.gz".format(self.fileprefix, day)
+            try:
+                newfile = not os.path.exists(filename)
+                with gzip.open(filename, "at", encoding="utf-8", newline="") as f:
+                    self.writecsv(f, dayrows, header=newfile)
+            except OSError as e:
+                Domoticz.Error("Error writing history file '{}': {}".format(filename, e))
+
+    def export(self, f):
+        # csv export of the records in the buffer
+        self.writecsv(f, self.rows(), header=True)
+
+    def writecsv(self, f, rows, header):
+        writer = csv.writer(f)
+        if header:
+            writer.writerow(self.FIELDS)
+        for row in rows:
+            writer.writerow((datetime.fromtimestamp(row[0]).isoformat(timespec="seconds"),) +
+                            tuple(round(value, 2) for value in row[1:5]) + tuple(int(value) for value in row[5:]))
+
+
+class DeviceSnapshot:
+
+    # Shared cache of the domoticz devices read through the API, indexed by idx.
+    # A getdevices&filter= result serves every consumer (and every zone) during ttl seconds. When only
+    # a few devices are watched, they are read one by one with getdevices&rid= instead of the full list.
+    # When the API fails, the last good values are served for up to maxstale seconds. The devices pushed by a
+    # direct transport (see push()) are served from their last values and not read from the API anymore.
+
+    def __init__(self, api, ttl=10.0, ridthreshold=3, maxstale=300.0):
+        self.api = api
+        self.ttl = ttl
+        self.maxstale = maxstale
+        self.ridthreshold = ridthreshold
+        self.watched = {}  # filter: set of idx used by the zones
+        self.filters = {}  # filter: (read time, {idx: device})
+        self.devices = {}  # idx: (read time, device) for the devices read with rid=
+        self.pushed = {}  # idx: device kept up to date by a direct transport
+
+    def get(self, devfilter, idxlist, ttl=None):
+        # returns {idx: device} for the wanted idx found in domoticz, read again if older than ttl (default self.ttl)
+        pushed = {idx: self.pushed[idx] for idx in idxlist if idx in self.pushed}
+        if pushed:
+            idxlist = [idx for idx in idxlist if idx not in pushed]
+            if not idxlist:
+                return pushed
+            devices = self._get(devfilter, idxlist, ttl)
+            devices.update(pushed)
+            return devices
+        return self._get(devfilter, idxlist, ttl)
+
+    def _get(self, devfilter, idxlist, ttl):
+        now = time.monotonic()
+        ttl = self.ttl if ttl is None else ttl
+        if devfilter is None or len(self.watched.get(devfilter) or idxlist) <= self.ridthreshold:
+            return {idx: device for idx, device in ((idx, self._getrid(idx, now, ttl)) for idx in idxlist) if device}
+        readtime, devices = self.filters.get(devfilter, (None, None))
+        if readtime is None or now - readtime > ttl:
+            fresh = self._getfilter(devfilter)
+            if fresh is not None:
+                devices = fresh
+                self.filters[devfilter] = (now, devices)
+            elif readtime is None or now - readtime > self.maxstale:
+                return {}
+        return {idx: devices[idx] for idx in idxlist if idx in devices}
+
+    def _getfilter(self, devfilter):
+        devicesAPI = self.api.call("type=command&param=getdevices&filter={}&used=true".format(devfilter))
+        if not devicesAPI:
+            return None
+        return {int(device["idx"]): device for device in devicesAPI.get("result", [])}
+
+    def _getrid(self, idx, now, ttl):
+        readtime, device = self.devices.get(idx, (None, None))
+        if readtime is None or now - readtime > ttl:
+            deviceAPI = self.api.call("type=command&param=getdevices&rid={}".format(idx))
+            if deviceAPI is None:
+                return device if readtime is not None and now - readtime <= self.maxstale else None
+            device = deviceAPI["result"][0] if deviceAPI.get("result") else None
+            self.devices[idx] = (now, device)
+        return device
+
+    def watch(self, devfilter, idxlist):
+        # register devices read with this filter, so the read mode is chosen on the total for all the zones
+        self.watched.setdefault(devfilter, set()).update(idxlist)
+
+    def update(self, idx, fields):
+        # patch a cached device with values received from an event, returns False if it is not cached
+        found = False
+        for readtime, devices in self.filters.values():
+            if idx in devices:
+                devices[idx].update(fields)
+                found = True
+        readtime, device = self.devices.get(idx, (None, None))
+        if device:
+            device.update(fields)
+            found = True
+        return found
+
+    def push(self, idx, fields):
+        # values received from a direct transport: once the device has been read from the API, it is served
+        # from them, returns False if the device is not known yet
+        found = self.update(idx, fields)
+        device = self.pushed.get(idx)
+        if device is not None:
+            device.update(fields)
+            return True
+        device = next((devices[idx] for readtime, devices in self.filters.values() if idx in devices), None)
+        device = device or self.devices.get(idx, (None, None))[1]
+        if device is None:
+            return found
+        self.pushed[idx] = dict(device)
+        return True
+
+    def unpush(self):
+        # the direct transport is lost: read the devices from the API again
+        self.pushed.clear()
+
+    def invalidate(self, idx=None):
+        # forget a device (or everything) so that the next get() reads it again
+        if idx is None:
+            self.filters.clear()
+            self.devices.clear()
+            return
+        self.devices.pop(idx, None)
+        for devfilter in [f for f, (t, devices) in self.filters.items() if idx in devices]:
+            del self.filters[devfilter]
+
+
+def Median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    return values[middle] if len(values) % 2 else (values[middle - 1] + values[middle]) / 2
+
+
+def FuseTemperatures(readings, fusion):
+
+    # weighted average of the (idx, temperature) readings. With 3 readings or more, the ones further
+    # than mad_threshold median absolute deviations from the median are rejected first.
+    if len(readings) >= 3 and fusion["mad_threshold"] > 0:
+        median = Median([temp for idx, temp in readings])
+        mad = Median([abs(temp - median) for idx, temp in readings])
+        limit = fusion["mad_threshold"] * max(mad * 1.4826, 0.1)  # scaled MAD, never below 0.1 degree
+        kept = [(idx, temp) for idx, temp in readings if abs(temp - median) <= limit]
+        for idx, temp in readings:
+            if abs(temp - median) > limit:
+                Log.debug("temps", "Temperature {} of sensor {} rejected as outlier (median {})", temp, idx, median)
+        readings = kept or readings
+    weights = fusion["weights"]
+    total = sum(weights.get(idx, 1.0) for idx, temp in readings)
+    if total <= 0:
+        return sum(temp for idx, temp in readings) / len(readings)
+    return sum(weights.get(idx, 1.0) * temp for idx, temp in readings) / total
+
+
+# Decision kernel ---------------------------------------------------
+# The control / mode / pause / forced / presence state machine of the zones, without any device, log or
+# clock access. The zones are given as columns (one list or array per field of DECISIONFIELDS, times as
+# timestamps, delays in minutes) and the result is a list of (zone index, name, value) actions: the
+# new values that changed, the heating request counters and the "event" of the zone, used for the logs.
+
+DECISIONFIELDS = ("control", "mode", "level", "normal", "eco", "presence", "reducjour", "reducnuit",
+                  "predicted", "trvtemp", "heat", "intemperror", "forced", "endheat", "forcedduration",
+                  "pause", "pauserequested", "pausechanged", "pauseondelay", "pauseoffdelay",
+                  "switchHeat", "setpoint", "TRVsetpoint", "TRVheld", "TRVsent", "TRVchanged", "heatchanged",
+                  "TRVsentfor")
+DECISIONOUTPUTS = ("control", "forced", "endheat", "pause", "switchHeat", "setpoint", "TRVsetpoint", "TRVheld",
+                   "heat", "heatchanged")
+DECISIONEVENTS = ("off", "off_heat", "forced", "forced_on", "forced_end", "auto", "forced_off", "pause_off",
+                  "pause_on", "night", "scheduled_eco", "normal", "reduced", "eco", "vacation")
+CONTROLCODES = {"0": 0, "10": 10, "20": 20}  # Thermostat Control levels, anything else is auto
+MODECODES = {"10": 10, "20": 20}  # Thermostat Mode levels, anything else is vacation (30)
+LEVELCODES = {"comfort": 0, "night": 1, "eco": 2}
+
+_OFFLOGS = (("verbose", "Thermostat is OFF", None),
+            ("debug", "TRV Calculded setpoint is : 7 because of thermostat off", None))
+_FORCEDLOG = ("verbose", "Thermostat is in FORCED mode", None)
+_AUTOLOG = ("debug", "Thermostat is in AUTO mode", None)
+_TRVLOG = ("debug", "TRV Calculded setpoint is : {}", "TRVsetpoint")
+DECISIONLOGS = {  # event: (log level, message, zone attribute in the message)
+    "off": _OFFLOGS,
+    "off_heat": _OFFLOGS + (("debug", "Switching heat Off !", None),),
+    "forced": (_FORCEDLOG,),
+    "forced_on": (_FORCEDLOG, ("debug", "Forced mode On !", None), ("debug", "TRV Calculded setpoint is : 28", None)),
+    "forced_end": (_FORCEDLOG, ("debug", "Forced mode Off after timer !", None), _TRVLOG),
+    "auto": (_AUTOLOG,),
+    "forced_off": (_AUTOLOG, ("debug", "Forced mode Off !", None), _TRVLOG),
+    "pause_off": (_AUTOLOG, ("debug", "Pause is now Off", None), _TRVLOG),
+    "pause_on": (_AUTOLOG, ("debug", "Pause is now On", None), ("debug", "TRV Calculded setpoint is : 7", None)),
+    "night": (_AUTOLOG, ("verbose", "AUTO Mode - used setpoint is night one : {}", "setpoint"), _TRVLOG),
+    "scheduled_eco": (_AUTOLOG, ("verbose", "AUTO Mode - used setpoint is scheduled ECO one : {}", "setpoint"), _TRVLOG),
+    "normal": (_AUTOLOG, ("verbose", "AUTO Mode - used setpoint is NORMAL : {}", "setpoint"), _TRVLOG),
+    "reduced": (_AUTOLOG, ("verbose", "AUTO Mode - used setpoint is reducted one : {}", "setpoint"), _TRVLOG),
+    "eco": (_AUTOLOG, ("verbose", "ECO Mode - used setpoint is ECO one : {}", "setpoint"), _TRVLOG),
+    "vacation": (_AUTOLOG, ("verbose", "VACATION Mode - used setpoint is VACATION one : {}", "setpoint"), _TRVLOG),
+}
+
+
+def DecisionColumns(rows):
+
+    # per zone tuples of DECISIONFIELDS values to one list per field
+    if not rows:
+        return {field: [] for field in DECISIONFIELDS}
+    return dict(zip(DECISIONFIELDS, map(list, zip(*rows))))
+
+
+def Decide(columns, now, hysteresis):
+
+    # actions of all the zones, in the order of the zones
+    actions = []
+    for index, row in enumerate(zip(*(columns[field] for field in DECISIONFIELDS))):
+        DecideZone(index, row, now, hysteresis, actions)
+    return actions
+
+
+def DecideZone(index, row, now, hysteresis, actions):
+
+    z = dict(zip(DECISIONFIELDS, row))
+    correct = False
+    if z["control"] == 0:  # Thermostat is off
+        event = "off_heat" if z["forced"] or z["switchHeat"] else "off"
+        z.update(TRVsetpoint=7, heat=False, forced=False, switchHeat=False)
+
+    elif z["control"] == 20:  # Thermostat is in forced mode
+        if not z["forced"]:
+            event = "forced_on"
+            z.update(forced=True, endheat=now + 60 * z["forcedduration"], switchHeat=True, TRVsetpoint=28, heat=True)
+        elif z["endheat"] <= now:
+            event = "forced_end"
+            z.update(forced=False, endheat=now, control=10, switchHeat=False, heat=False)
+            correct = True
+        else:
+            event = "forced"
+
+    else:  # Thermostat is in mode auto
+        event = "auto"
+        if z["forced"]:  # thermostat setting was just changed from "forced" so we kill the forced mode
+            event = "forced_off"
+            z.update(forced=False, switchHeat=True, heat=False)
+            correct = True
+        elif z["pause"] != z["pauserequested"]:  # the pause switch changed, pause follows after its delay
+            delay = z["pauseoffdelay"] if z["pause"] else z["pauseondelay"]
+            if z["pausechanged"] + 60 * delay <= now:
+                if z["pause"]:
+                    event = "pause_off"
+                    z.update(pause=False, switchHeat=True)
+                    correct = True
+                else:
+                    event = "pause_on"
+                    z.update(pause=True, switchHeat=False, TRVsetpoint=7, heat=False)
+        else:
+            z["switchHeat"] = True
+            correct = True
+            if z["mode"] == 10:  # Mode Auto
+                if z["level"] == 1:
+                    event, z["setpoint"] = "night", z["normal"] - z["reducnuit"] / 10
+                elif z["level"] == 2:
+                    event, z["setpoint"] = "scheduled_eco", z["eco"]
+                elif z["presence"]:
+                    event, z["setpoint"] = "normal", z["normal"]
+                else:
+                    event, z["setpoint"] = "reduced", z["normal"] - z["reducjour"] / 10
+            elif z["mode"] == 20:  # Mode ECO
+                event, z["setpoint"] = "eco", z["eco"]
+            else:
+                event, z["setpoint"] = "vacation", 15  # Mode Vacances
+
+    if correct:
+        # correction of TRV setpoint using difference between real indoor temp and mesured trv temp.
+        z["TRVsetpoint"], z["TRVheld"] = CorrectedSetpoint(z["setpoint"], z["predicted"], z["trvtemp"], z["TRVsent"],
+                                                           z["TRVchanged"], now, hysteresis, z["TRVsentfor"])
+
+    # heating request, unless forced or without inside temperature
+    if not z["forced"]:
+        if z["switchHeat"] and not z["intemperror"]:
+            z["heat"], counter = HeatRequest(z["heat"], z["predicted"], z["setpoint"], z["heatchanged"], now, hysteresis)
+            if counter:
+                actions.append((index, counter, 1))
+                if counter == "heat_issued":
+                    z["heatchanged"] = now
+        else:
+            z["heat"] = False
+
+    for position, field in enumerate(DECISIONFIELDS):
+        if field in DECISIONOUTPUTS and z[field] != row[position]:
+            actions.append((index, field, z[field]))
+    actions.append((index, "event", event))
+
+
+def CorrectedSetpoint(setpoint, predicted, trvtemp, last, changed, now, hysteresis, sentfor=math.nan):
+
+    # TRV setpoint corrected by the difference between the inside and the TRV temperatures, and if it is held.
+    # The last value sent to the TRV (nan if none) is kept while the correction stays within the hysteresis
+    # band around it, and for at least the minimum hold time. This only damps the corrections: a new zone
+    # setpoint (setpoint, mode or forced change since sentfor, the setpoint of the last value) goes through.
+    raw = setpoint - (predicted - trvtemp)
+    target = math.ceil(raw)
+    if math.isnan(last) or target == last or last in (7, 28) or setpoint != sentfor:
+        return target, False
+    band = hysteresis["trv"]
+    if last - 1 - band < raw <= last + band or changed + 60 * hysteresis["trv_hold"] > now:
+        return last, True
+    return target, False
+
+
+def HeatRequest(on, predicted, setpoint, changed, now, hysteresis):
+
+    # heating request with an hysteresis band around the setpoint and a minimum time between changes,
+    # and the counter to increment: "heat_issued", "heat_suppressed" or None
+    band = hysteresis["heat"]
+    wanted = predicted < setpoint + (band if on else -band)
+    if wanted == on:
+        return on, None
+    if changed + 60 * hysteresis["heat_hold"] > now:
+        return on, "heat_suppressed"
+    return wanted, "heat_issued"
+
+
+def LoadSettings():
+
+    # optional advanced settings, read from settings.json in the plugin folder.
+    # top level sections apply to every instance, "hardware" -> "<HardwareID>" sections override them.
+    settings = {}
+    filename = os.path.join(Parameters["HomeFolder"], "settings.json")
+    if not os.path.isfile(filename):
+        return settings
     try:
-        Domoticz.Debug(f"Domoticz API request: {url}")
-        req = request.Request(url)
-        response = request.urlopen(req)
-
-        if response.status == 200:
-            resultJson = json.loads(response.read().decode('utf-8'))
-            if resultJson.get("status") != "OK":
-                Domoticz.Error(f"Domoticz API returned an error: status = {resultJson.get('status')}")
-                resultJson = None
+        with open(filename, encoding="utf-8") as f:
+            allsettings = json.load(f)
+    except (OSError, ValueError) as e:
+        Domoticz.Error(f"Error reading settings file '{filename}': {e}")
+        return settings
+    overrides = allsettings.pop("hardware", {}).get(str(Parameters["HardwareID"]), {})
+    for section, values in itertools.chain(allsettings.items(), overrides.items()):
+        if isinstance(values, dict):
+            settings.setdefault(section, {}).update(values)
         else:
-            Domoticz.Error(f"Domoticz API: HTTP error = {response.status}")
-
-
-    except urlerror.HTTPError as e:
-        Domoticz.Error(f"HTTP error calling '{url}': {e}")
-
-    except urlerror.URLError as e:
-        Domoticz.Error(f"URL error calling '{url}': {e}")
-
-    except json.JSONDecodeError as e:
-        Domoticz.Error(f"JSON decoding error: {e}")
-
-    except Exception as e:
-        Domoticz.Error(f"Error calling '{url}': {e}")
-
-    return resultJson
-
+            settings[section] = values
+    Domoticz.Debug(f"Advanced settings = {settings}")
+    return settings
 
 
 def CheckParam(name, value, default):